@@ -1,37 +1,80 @@
+import atexit
+import io
 import os
 import subprocess
-import tempfile
-import uuid
 import base64
-import json
+import glob
 import logging
+import queue
+import re
+import secrets
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
-from logging.handlers import RotatingFileHandler
-from flask import Flask, request, render_template, jsonify, send_file
-from flask_cors import CORS
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from flask import Flask, Response, request, render_template, jsonify, send_file, stream_with_context, copy_current_request_context
+from flask.json.provider import DefaultJSONProvider
 from werkzeug.utils import secure_filename
-from openai import OpenAI
-from denoise_pipeline import run_denoise
+import numpy as np
 from PIL import Image
-from math_chatbot import math_engine, format_reply
 from dotenv import load_dotenv
 
-# Load environment variables from .env file
+# Load environment variables from .env file before the local modules below,
+# which read their settings at import time
 load_dotenv()
 
+from denoise_pipeline import run_denoise
+from math_chatbot import math_engine, format_reply
+from llm_client import create_chat_completion, get_client
+from jsonl_writer import JSONLWriter
+
+# Optional deps
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # =============== CONFIGURATION ===============
 DOCS_DIR = os.getenv("DOCS_DIR", "notes_out")
 FEEDBACK_DIR = os.getenv("FEEDBACK_DIR", "notes_feedback")
+# latexmk keeps aux files, logs and its dependency database here, reused
+# across compiles (relative to DOCS_DIR, where latexmk runs)
+LATEX_AUX_NAME = ".latexcache"
+LATEX_AUX_DIR = os.path.join(DOCS_DIR, LATEX_AUX_NAME)
 MODEL_NAME = os.getenv("MODEL_NAME", "gpt-4o")
 API_KEY = os.getenv("OPENAI_API_KEY") or os.getenv("DEEPSEEK_API_KEY")
 BASE_URL = os.getenv("OPENAI_BASE_URL")  # Optional custom endpoint
 MAX_FILE_SIZE_MB = int(os.getenv("MAX_FILE_SIZE_MB", "16"))
 TIMEOUT_SECONDS = int(os.getenv("TIMEOUT_SECONDS", "120"))  # Increased for mobile
+MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "3"))  # Retries on 429/5xx/connection errors
+DENOISE_WORKERS = int(os.getenv("DENOISE_WORKERS", "8"))  # Max images denoised in parallel per request
+
+# Vision payload budget: enhanced images are downscaled so the longest edge is
+# at most VISION_MAX_EDGE px. Black-and-white enhanced images are sent as 1-bit
+# PNG (several times smaller than JPEG); anything else is encoded as JPEG at
+# VISION_JPEG_QUALITY.
+# Single images are sent at "high" detail; multi-image requests at "low"
+# detail to bound prompt tokens. Larger payloads cost latency and tokens
+# without improving transcription.
+VISION_MAX_EDGE = int(os.getenv("VISION_MAX_EDGE", "2048"))
+VISION_JPEG_QUALITY = int(os.getenv("VISION_JPEG_QUALITY", "85"))
+VISION_DETAIL_SINGLE = os.getenv("VISION_DETAIL_SINGLE", "high")
+VISION_DETAIL_MULTI = os.getenv("VISION_DETAIL_MULTI", "low")
+# Send each image of a multi-image upload as its own concurrent vision request
+# and splice the results, instead of one combined request. Streaming uploads
+# always use the combined request.
+SPLIT_VISION_REQUESTS = os.getenv("SPLIT_VISION_REQUESTS", "false").lower() == "true"
 DEBUG = os.getenv("FLASK_DEBUG", "false").lower() == "true"
 PORT = int(os.getenv("PORT", "8000"))
 HOST = os.getenv("HOST", "0.0.0.0")
 
+# Pins transcription requests to the same OpenAI prompt cache so the shared
+# system prompt is only prefilled once. Only sent to OpenAI's own endpoint.
+PROMPT_CACHE_KEY = "lecture-notes"
+CACHE_PARAMS = {} if BASE_URL else {"extra_body": {"prompt_cache_key": PROMPT_CACHE_KEY}}
+
 # Validate critical configuration
 if not API_KEY or API_KEY == "sk-your-key-here":
     raise ValueError("OPENAI_API_KEY must be set in environment or .env file")
@@ -40,28 +83,54 @@ if not API_KEY or API_KEY == "sk-your-key-here":
 
 app = Flask(__name__)
 
-# CORS configuration for mobile app
-CORS(app, resources={
-    r"/*": {
-        "origins": "*",  # Allow all origins for development; restrict in production
-        "methods": ["GET", "POST", "DELETE", "OPTIONS"],
-        "allow_headers": ["Content-Type", "X-Request-ID"],
-        "expose_headers": ["X-Request-ID"],
-    }
-})
+# CORS configuration for mobile app. The policy is fixed, so the headers are
+# built once and added to every response (including OPTIONS preflights).
+CORS_HEADERS = {
+    "Access-Control-Allow-Origin": "*",  # Allow all origins for development; restrict in production
+    "Access-Control-Allow-Methods": "GET, POST, DELETE, OPTIONS",
+    "Access-Control-Allow-Headers": "Content-Type, X-Request-ID",
+    "Access-Control-Expose-Headers": "X-Request-ID",
+}
+
+@app.after_request
+def add_cors_headers(response):
+    response.headers.update(CORS_HEADERS)
+    return response
 
 app.config['MAX_CONTENT_LENGTH'] = MAX_FILE_SIZE_MB * 1024 * 1024
-app.config['UPLOAD_FOLDER'] = tempfile.gettempdir()
-app.config['JSON_SORT_KEYS'] = False  # Preserve JSON key order
+
+# JSON serialization: use orjson when installed (much faster on large LaTeX
+# payloads); both paths preserve key order
+class ORJSONProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson"""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+if orjson is not None:
+    app.json = ORJSONProvider(app)
+else:
+    app.json.sort_keys = False
 
 # =============== LOGGING SETUP ===============
+# Request threads only format and enqueue log records; a background listener
+# thread does the file and console writes so disk I/O stays off the request path.
+log_queue = queue.SimpleQueue()
+log_listener = QueueListener(
+    log_queue,
+    RotatingFileHandler('app.log', maxBytes=10*1024*1024, backupCount=3),
+    logging.StreamHandler(sys.stdout)
+)
+log_listener.start()
+atexit.register(log_listener.stop)
+
 logging.basicConfig(
     level=logging.INFO if not DEBUG else logging.DEBUG,
     format='%(asctime)s [%(levelname)s] %(name)s: %(message)s',
-    handlers=[
-        RotatingFileHandler('app.log', maxBytes=10*1024*1024, backupCount=3),
-        logging.StreamHandler(sys.stdout)
-    ]
+    handlers=[QueueHandler(log_queue)]
 )
 
 logger = logging.getLogger(__name__)
@@ -69,30 +138,33 @@ logger = logging.getLogger(__name__)
 # Request ID middleware for tracking
 @app.before_request
 def add_request_id():
-    request.request_id = request.headers.get('X-Request-ID', str(uuid.uuid4()))
-    logger.info(f"[{request.request_id}] {request.method} {request.path}")
+    request_id = request.headers.get('X-Request-ID') or secrets.token_hex(8)
+    request.request_id = request_id
+    logger.info("[%s] %s %s", request_id, request.method, request.path)
 
 @app.after_request
 def add_request_id_header(response):
-    if hasattr(request, 'request_id'):
-        response.headers['X-Request-ID'] = request.request_id
+    request_id = getattr(request, 'request_id', None)
+    if request_id is not None:
+        response.headers['X-Request-ID'] = request_id
     return response
 
 # =============== RESPONSE HELPERS ===============
 def error_response(error_code, message, status=400, details=None):
     """Return standardized error response with request ID"""
+    request_id = getattr(request, 'request_id', None)
     response = {
         'success': False,
         'error': {
             'code': error_code,
             'message': message,
-            'request_id': getattr(request, 'request_id', None)
+            'request_id': request_id
         }
     }
     if details and DEBUG:
         response['error']['details'] = details
 
-    logger.error(f"[{getattr(request, 'request_id', 'N/A')}] Error {error_code}: {message}")
+    logger.error("[%s] Error %s: %s", request_id or 'N/A', error_code, message)
     return jsonify(response), status
 
 def success_response(data, message=None):
@@ -108,350 +180,536 @@ def success_response(data, message=None):
 
 os.makedirs(DOCS_DIR, exist_ok=True)
 os.makedirs(FEEDBACK_DIR, exist_ok=True)
+os.makedirs(LATEX_AUX_DIR, exist_ok=True)
+
+# Feedback lines are appended in batches by a background thread
+feedback_writer = JSONLWriter()
 
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp'}
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def encode_image_to_base64(image_path):
-    """Encode an image file to base64 string for vision API"""
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode('utf-8')
-
-def get_image_mime_type(image_path):
-    """Determine MIME type based on file extension"""
-    ext = image_path.lower().split('.')[-1]
-    mime_types = {
-        'jpg': 'image/jpeg',
-        'jpeg': 'image/jpeg',
-        'png': 'image/png',
-        'gif': 'image/gif',
-        'bmp': 'image/bmp',
-        'webp': 'image/webp'
+def encode_image_data_url(image_file, mime_type):
+    """
+    Build a base64 data URL for the vision API from an in-memory image
+    file, encoding its buffer directly instead of copying the bytes out first.
+    """
+    with image_file.getbuffer() as data:
+        encoded = base64.b64encode(data)
+    return f"data:{mime_type};base64," + encoded.decode('ascii')
+
+def is_bilevel(image):
+    """True for a single-channel array that only contains black and white"""
+    return image.ndim == 2 and not np.any((image != 0) & (image != 255))
+
+def prepare_vision_image(image):
+    """
+    Fit an enhanced image (an OpenCV array) to the vision budget
+    (VISION_MAX_EDGE) and encode it as compactly as possible.
+    Returns an in-memory file positioned at the start and its MIME type.
+    """
+    bilevel = is_bilevel(image)
+    with Image.fromarray(image) as img:
+        img.thumbnail((VISION_MAX_EDGE, VISION_MAX_EDGE), Image.Resampling.LANCZOS)
+        out = io.BytesIO()
+        if bilevel:
+            # Re-threshold after the antialiased downscale; 1-bit PNG is
+            # lossless for black-and-white notes and far smaller than JPEG
+            img.point(lambda v: 255 if v > 127 else 0).convert('1').save(out, format='PNG')
+            mime_type = 'image/png'
+        else:
+            img.save(out, format='JPEG', quality=VISION_JPEG_QUALITY)
+            mime_type = 'image/jpeg'
+    out.seek(0)
+    return out, mime_type
+
+# Prompts for the vision transcription request, built once at import
+SYSTEM_PROMPT = (
+    "You are a LaTeX math transcription AND explanation assistant using GPT-4o vision capabilities. "
+    "You will be given images of handwritten mathematics from a blackboard. "
+    "Your task is to carefully analyze the images, understand the mathematical content, and "
+    "produce a polished, structured LaTeX article with detailed explanations.\n\n"
+
+    "=== CORE TASKS ===\n"
+    "1. Carefully examine the images and transcribe all mathematical content into proper LaTeX.\n"
+    "2. Add clear explanatory text (in full sentences) before or after each major step, "
+    "suitable for an advanced undergraduate or beginning graduate student.\n"
+    "3. Preserve all important equations, derivations, and logical structure.\n"
+    "4. Interpret handwritten symbols, equations, and mathematical notation accurately using your vision capabilities.\n\n"
+
+    "=== STRICT LATEX RULES ===\n"
+    "• Every mathematical symbol or expression MUST be in math mode.\n"
+    "  – Inline math → \\( ... \\)\n"
+    "  – Display math → \\[ ... \\]\n"
+    "• Never leave raw math symbols in text (e.g. x^2, sum, int, a/b).\n"
+    "• Use correct LaTeX operators: \\ker, \\operatorname{Gal}, \\Hom, \\bQ, \\bZ, \\mod, \\leq, etc.\n"
+    "• Use standard formatting for groups, fields, cosets, cyclotomic extensions, etc.\n"
+    "• No markdown code fences. ONLY pure LaTeX.\n\n"
+
+    "=== DOCUMENT STRUCTURE ===\n"
+    "• Output a complete LaTeX document:\n"
+    "  \\documentclass[12pt]{article}\n"
+    "  \\usepackage{amsmath, amssymb, amsfonts, amsthm}\n"
+    "  ...\n"
+    "  \\begin{document}\n"
+    "  ... content ...\n"
+    "  \\end{document}\n"
+    "• Use sections, subsections, and paragraphs to organize the material.\n"
+    "• You may use environments such as theorem, definition, remark, proof, itemize, or enumerate.\n"
+    "• Explanations must also follow the strict math-mode rules when referencing symbols.\n\n"
+
+    "=== STYLE REQUIREMENTS ===\n"
+    "Your output should resemble a clean textbook or research monograph style similar to "
+    "graduate-level algebraic number theory literature. "
+    "Ensure consistent math-mode usage, operator spacing, and paragraph structure.\n\n"
+
+    "If something in an image is ambiguous or unreadable, include a LaTeX comment '% unclear'.\n"
+    "Output ONLY LaTeX, with no markdown and no external commentary."
+)
+
+INSTRUCTION_SINGLE = (
+    "Please analyze this image of handwritten mathematics from a blackboard using your vision capabilities. "
+    "Transcribe all mathematical content into clean LaTeX, using article class with packages: amsmath and amssymb. "
+    "Insert detailed explanations and commentary in LaTeX so that a reader can follow the reasoning.\n\n"
+    "You should keep the original mathematical content and derivations, but you are encouraged to:\n"
+    "• Organize the material with sections/subsections,\n"
+    "• Add short explanatory paragraphs around each important formula or step, and\n"
+    "• Clarify the meaning of symbols and assumptions when they are implicit.\n"
+    "• Include \\usepackage{amsmath} and \\usepackage{amssymb} in the preamble."
+)
+
+INSTRUCTION_MULTI_FMT = (
+    "Please analyze these {n} images of handwritten mathematics from a blackboard using your vision capabilities. "
+    "They may be part of a sequence of related content. "
+    "Transcribe all mathematical content from all images into a single coherent LaTeX document, "
+    "using article class with packages: amsmath and amssymb. "
+    "Insert detailed explanations and commentary in LaTeX so that a reader can follow the reasoning.\n\n"
+    "You should keep the original mathematical content and derivations, but you are encouraged to:\n"
+    "• Combine all images into a single coherent document,\n"
+    "• Organize the material with sections/subsections,\n"
+    "• Add short explanatory paragraphs around each important formula or step, and\n"
+    "• Clarify the meaning of symbols and assumptions when they are implicit.\n"
+    "• Include \\usepackage{{amsmath}} and \\usepackage{{amssymb}} in the preamble."
+)
+
+def vision_image_entry(enhanced, detail):
+    image_file, mime_type = prepare_vision_image(enhanced)
+    return {
+        "type": "image_url",
+        "image_url": {
+            "url": encode_image_data_url(image_file, mime_type),
+            "detail": detail,
+        }
     }
-    return mime_types.get(ext, 'image/jpeg')
 
-def process_images_to_latex(image_paths):
+def vision_separator_entry(idx, count):
+    if idx == count - 1:
+        return None
+    return {"type": "text", "text": f"\n--- End of Image {idx + 1} / {count} ---\n"}
+
+def build_vision_content(enhanced_images):
+    """Build the user message content (instructions + images) in OpenAI vision format"""
+    # Add text instruction
+    if len(enhanced_images) == 1:
+        instruction_text = INSTRUCTION_SINGLE
+    else:
+        instruction_text = INSTRUCTION_MULTI_FMT.format(n=len(enhanced_images))
+
+    # Each image entry is followed by a separator, except the last one
+    detail = VISION_DETAIL_SINGLE if len(enhanced_images) == 1 else VISION_DETAIL_MULTI
+    count = len(enhanced_images)
+    logger.debug("Encoding %d image(s) for vision API", count)
+    return [{"type": "text", "text": instruction_text}] + [
+        entry
+        for idx, enhanced in enumerate(enhanced_images)
+        for entry in (
+            vision_image_entry(enhanced, detail),
+            vision_separator_entry(idx, count),
+        )
+        if entry is not None
+    ]
+
+# Opening fence with an optional language tag, and the closing fence
+CODE_FENCE_OPEN_RE = re.compile(r"\s*```[A-Za-z]*[ \t]*\n?")
+CODE_FENCE_CLOSE_RE = re.compile(r"\s*```\s*\Z")
+
+def strip_code_fences(latex_source):
+    """Remove markdown code fences the model may wrap around the LaTeX"""
+    opening = CODE_FENCE_OPEN_RE.match(latex_source)
+    if not opening:
+        return latex_source
+    closing = CODE_FENCE_CLOSE_RE.search(latex_source, opening.end())
+    end = closing.start() if closing else len(latex_source)
+    return latex_source[opening.end():end].strip()
+
+# Preamble lines that only make sense once per document
+SPLICE_SKIP_PREFIXES = ("\\documentclass", "\\title", "\\author", "\\date")
+
+def splice_latex_documents(documents):
+    """
+    Merge per-image LaTeX documents into one: preamble lines are merged
+    without duplicates (one \\documentclass/\\title/\\author/\\date), and the
+    bodies are concatenated in image order.
+    """
+    preamble_lines = []
+    bodies = []
+    for idx, doc in enumerate(documents):
+        if "\\begin{document}" in doc:
+            preamble, body = doc.split("\\begin{document}", 1)
+        else:
+            preamble, body = "", doc
+        body = body.split("\\end{document}", 1)[0].strip()
+        for line in preamble.splitlines():
+            stripped = line.strip()
+            if not stripped or stripped in preamble_lines:
+                continue
+            once = next((p for p in SPLICE_SKIP_PREFIXES if stripped.startswith(p)), None)
+            if once and any(seen.startswith(once) for seen in preamble_lines):
+                continue
+            preamble_lines.append(stripped)
+        if idx > 0:
+            body = body.replace("\\maketitle", "").strip()
+        bodies.append(f"% --- Image {idx + 1} / {len(documents)} ---\n{body}")
+
+    return (
+        "\n".join(preamble_lines)
+        + "\n\\begin{document}\n"
+        + "\n\n".join(bodies)
+        + "\n\\end{document}\n"
+    )
+
+DOCCLASS_RE = re.compile(r'\\documentclass[^\n]*\n?')
+USEPACKAGE_RE = re.compile(r'\\usepackage(?:\[[^\]]*\])?\{([^}]*)\}')
+AMSMATH_RE = re.compile(r'\\usepackage\{amsmath\}')
+BEGIN_DOCUMENT = "\\begin{document}"
+END_DOCUMENT = "\\end{document}"
+
+def ensure_preamble(src):
+    """
+    Repair a generated document in one pass: wrap bare content in an article,
+    make sure amsmath/amssymb are loaded (needed for symbols like \\lhd,
+    \\rhd, etc.) and that \\begin{document}/\\end{document} are paired.
+    """
+    docclass = DOCCLASS_RE.search(src)
+    if docclass is None:
+        # Missing document class - wrap the content
+        return "".join([
+            "\\documentclass{article}\n\\usepackage{amsmath}\n\\usepackage{amssymb}\n",
+            BEGIN_DOCUMENT, "\n", src, "\n", END_DOCUMENT,
+        ])
+
+    packages = {
+        name.strip()
+        for names in USEPACKAGE_RE.findall(src)
+        for name in names.split(",")
+    }
+    begin_pos = src.find(BEGIN_DOCUMENT)
+    has_end = END_DOCUMENT in src
+
+    amsmath = AMSMATH_RE.search(src)
+    parts = []
+    if "amssymb" in packages:
+        parts.append(src)
+    elif amsmath is not None:
+        parts += [src[:amsmath.end()], "\n\\usepackage{amssymb}", src[amsmath.end():]]
+    else:
+        missing = "".join(
+            f"\\usepackage{{{name}}}\n" for name in ("amsmath", "amssymb") if name not in packages
+        )
+        # Before \\begin{document}, or right after \\documentclass if there is none
+        split_at = begin_pos if begin_pos != -1 else docclass.end()
+        parts += [src[:split_at], missing, src[split_at:]]
+
+    if begin_pos == -1 and has_end:
+        # Has end but no begin - insert begin before end
+        fixed = "".join(parts)
+        end_pos = fixed.rfind(END_DOCUMENT)
+        return "".join([fixed[:end_pos], BEGIN_DOCUMENT, "\n", fixed[end_pos:]])
+    if begin_pos != -1 and not has_end:
+        # Has begin but no end - add end
+        parts += ["\n", END_DOCUMENT]
+    return "".join(parts)
+
+# Commands whose output is only correct after a second pdflatex run
+CROSS_REFERENCE_COMMANDS = (
+    "\\ref{", "\\eqref{", "\\pageref{", "\\autoref{", "\\cite{",
+    "\\tableofcontents", "\\listof", "\\bibliography",
+)
+
+def needs_second_pass(latex_source):
+    return any(command in latex_source for command in CROSS_REFERENCE_COMMANDS)
+
+# Toolchain warm-up: the first compile after an idle period pays for loading
+# latexmk (Perl), the pdflatex binary and its multi-MB format file from disk.
+# Doing that while the LLM is still writing hides it behind the API call.
+LATEX_WARMUP_INTERVAL = 60  # seconds between warm-ups under steady traffic
+latex_warmup = {'last': None, 'format_path': None}
+latex_warmup_lock = threading.Lock()
+
+def latex_format_path():
+    """Locate pdflatex.fmt once via kpsewhich; None if it can't be found"""
+    if latex_warmup['format_path'] is None:
+        try:
+            result = subprocess.run(
+                ["kpsewhich", "-engine=pdftex", "pdflatex.fmt"],
+                capture_output=True, text=True, timeout=10,
+            )
+            latex_warmup['format_path'] = result.stdout.strip()
+        except (OSError, subprocess.SubprocessError):
+            latex_warmup['format_path'] = ''
+    return latex_warmup['format_path'] or None
+
+def warm_latex_toolchain():
+    """Pull latexmk, pdflatex and the pdflatex format into the page cache"""
+    with latex_warmup_lock:
+        now = time.monotonic()
+        if latex_warmup['last'] is not None and now - latex_warmup['last'] < LATEX_WARMUP_INTERVAL:
+            return
+        latex_warmup['last'] = now
+
+    format_path = latex_format_path()
+    if format_path and hasattr(os, 'posix_fadvise'):
+        try:
+            fd = os.open(format_path, os.O_RDONLY)
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+            finally:
+                os.close(fd)
+        except OSError:
+            pass
+    for command in (["latexmk", "-v"], ["pdflatex", "--version"]):
+        try:
+            subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=10)
+        except (OSError, subprocess.SubprocessError):
+            pass
+
+def run_pdflatex(note_name, passes):
+    """
+    Compile a note with plain pdflatex. Aux files and the log go to
+    LATEX_AUX_DIR like latexmk's; the PDF is moved next to the .tex.
+    Returns the PDF path, or None if no PDF was produced. In nonstopmode a
+    document with minor errors still gets a PDF (and a nonzero exit);
+    CalledProcessError is only raised when pdflatex failed without one.
+    """
+    returncode = 0
+    for _ in range(passes):
+        returncode = subprocess.run(
+            [
+                "pdflatex", "-interaction=nonstopmode",
+                f"-output-directory={LATEX_AUX_NAME}", f"{note_name}.tex",
+            ],
+            cwd=DOCS_DIR,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            timeout=60,
+        ).returncode
+    built_path = os.path.join(LATEX_AUX_DIR, f"{note_name}.pdf")
+    if not os.path.exists(built_path):
+        if returncode:
+            raise subprocess.CalledProcessError(returncode, "pdflatex")
+        return None
+    pdf_path = os.path.join(DOCS_DIR, f"{note_name}.pdf")
+    os.replace(built_path, pdf_path)
+    return pdf_path
+
+def latex_log_errors(note_name, max_lines):
+    """Return the last max_lines error lines from a note's LaTeX log, or None"""
+    # Logs live in the aux directory; older notes have theirs next to the .tex
+    log_path = os.path.join(LATEX_AUX_DIR, f"{note_name}.log")
+    if not os.path.exists(log_path):
+        log_path = os.path.join(DOCS_DIR, f"{note_name}.log")
+    if not os.path.exists(log_path):
+        return None
+    with open(log_path, 'r', errors='ignore') as f:
+        error_lines = [line for line in f if 'Error' in line or 'Fatal' in line]
+    if not error_lines:
+        return None
+    return ''.join(error_lines[-max_lines:]).rstrip('\n')
+
+def process_images_to_latex(image_paths, on_delta=None):
     """
     Process multiple images through the full pipeline: denoise -> GPT-4o Vision -> LaTeX
+    Each entry of image_paths is a file path or a (base_name, image_bytes) tuple.
     Sends images directly to GPT-4o vision API instead of using OCR.
     Combines all images into a single LaTeX document.
+    If on_delta is given, the completion is streamed and on_delta is called
+    with each chunk of LaTeX text as it arrives.
     Returns the LaTeX source code and paths to generated files.
     """
-    # Create a temporary processed directory for this session
-    session_id = str(uuid.uuid4())
-    processed_dir = os.path.join(tempfile.gettempdir(), f"lecture_processed_{session_id}")
-    os.makedirs(processed_dir, exist_ok=True)
-    
-    try:
-        enhanced_images = []
-        
-        # Process each image through denoise pipeline
-        request_id = getattr(request, 'request_id', 'N/A')
-        for idx, image_path in enumerate(image_paths):
-            logger.info(f"[{request_id}] Processing image {idx + 1}/{len(image_paths)}...")
-
-            # Step 1: Run denoise pipeline
-            paths = run_denoise(in_path=image_path, processed_dir=processed_dir)
-            enh_path = paths["enhanced"]
-            logger.info(f"[{request_id}] Enhanced image saved: {enh_path}")
-            enhanced_images.append(enh_path)
-
-        logger.info(f"[{request_id}] Enhanced {len(enhanced_images)} images. Preparing for GPT-4o vision API...")
-
-        # Generate meaningful filename with date/time
-        now = datetime.now()
-        date_str = now.strftime('%Y-%m-%d_%H-%M-%S')
-        if len(image_paths) > 1:
-            note_name = f"notes_{date_str}_multi{len(image_paths)}"
-        else:
-            note_name = f"notes_{date_str}"
+    request_id = getattr(request, 'request_id', 'N/A')
 
-        # Step 2: Prepare images and call GPT-4o vision API
-        if BASE_URL:
-            client = OpenAI(api_key=API_KEY, base_url=BASE_URL, timeout=TIMEOUT_SECONDS)
-        else:
-            client = OpenAI(api_key=API_KEY, timeout=TIMEOUT_SECONDS)  # Use default OpenAI endpoint
-
-        system_prompt = (
-            "You are a LaTeX math transcription AND explanation assistant using GPT-4o vision capabilities. "
-            "You will be given images of handwritten mathematics from a blackboard. "
-            "Your task is to carefully analyze the images, understand the mathematical content, and "
-            "produce a polished, structured LaTeX article with detailed explanations.\n\n"
-
-            "=== CORE TASKS ===\n"
-            "1. Carefully examine the images and transcribe all mathematical content into proper LaTeX.\n"
-            "2. Add clear explanatory text (in full sentences) before or after each major step, "
-            "suitable for an advanced undergraduate or beginning graduate student.\n"
-            "3. Preserve all important equations, derivations, and logical structure.\n"
-            "4. Interpret handwritten symbols, equations, and mathematical notation accurately using your vision capabilities.\n\n"
-
-            "=== STRICT LATEX RULES ===\n"
-            "• Every mathematical symbol or expression MUST be in math mode.\n"
-            "  – Inline math → \\( ... \\)\n"
-            "  – Display math → \\[ ... \\]\n"
-            "• Never leave raw math symbols in text (e.g. x^2, sum, int, a/b).\n"
-            "• Use correct LaTeX operators: \\ker, \\operatorname{Gal}, \\Hom, \\bQ, \\bZ, \\mod, \\leq, etc.\n"
-            "• Use standard formatting for groups, fields, cosets, cyclotomic extensions, etc.\n"
-            "• No markdown code fences. ONLY pure LaTeX.\n\n"
-
-            "=== DOCUMENT STRUCTURE ===\n"
-            "• Output a complete LaTeX document:\n"
-            "  \\documentclass[12pt]{article}\n"
-            "  \\usepackage{amsmath, amssymb, amsfonts, amsthm}\n"
-            "  ...\n"
-            "  \\begin{document}\n"
-            "  ... content ...\n"
-            "  \\end{document}\n"
-            "• Use sections, subsections, and paragraphs to organize the material.\n"
-            "• You may use environments such as theorem, definition, remark, proof, itemize, or enumerate.\n"
-            "• Explanations must also follow the strict math-mode rules when referencing symbols.\n\n"
-
-            "=== STYLE REQUIREMENTS ===\n"
-            "Your output should resemble a clean textbook or research monograph style similar to "
-            "graduate-level algebraic number theory literature. "
-            "Ensure consistent math-mode usage, operator spacing, and paragraph structure.\n\n"
-
-            "If something in an image is ambiguous or unreadable, include a LaTeX comment '% unclear'.\n"
-            "Output ONLY LaTeX, with no markdown and no external commentary."
-        )
-        
-        # Build the user message content with text and images (OpenAI vision format)
-        user_content = []
-        
-        # Add text instruction
-        if len(enhanced_images) == 1:
-            instruction_text = (
-                "Please analyze this image of handwritten mathematics from a blackboard using your vision capabilities. "
-                "Transcribe all mathematical content into clean LaTeX, using article class with packages: amsmath and amssymb. "
-                "Insert detailed explanations and commentary in LaTeX so that a reader can follow the reasoning.\n\n"
-                "You should keep the original mathematical content and derivations, but you are encouraged to:\n"
-                "• Organize the material with sections/subsections,\n"
-                "• Add short explanatory paragraphs around each important formula or step, and\n"
-                "• Clarify the meaning of symbols and assumptions when they are implicit.\n"
-                "• Include \\usepackage{amsmath} and \\usepackage{amssymb} in the preamble."
-            )
+    def denoise_one(idx, image_path):
+        logger.info(f"[{request_id}] Processing image {idx + 1}/{len(image_paths)}...")
+
+        # Step 1: Run denoise pipeline
+        if isinstance(image_path, tuple):
+            base_name, source = image_path
         else:
-            instruction_text = (
-                f"Please analyze these {len(enhanced_images)} images of handwritten mathematics from a blackboard using your vision capabilities. "
-                "They may be part of a sequence of related content. "
-                "Transcribe all mathematical content from all images into a single coherent LaTeX document, "
-                "using article class with packages: amsmath and amssymb. "
-                "Insert detailed explanations and commentary in LaTeX so that a reader can follow the reasoning.\n\n"
-                "You should keep the original mathematical content and derivations, but you are encouraged to:\n"
-                "• Combine all images into a single coherent document,\n"
-                "• Organize the material with sections/subsections,\n"
-                "• Add short explanatory paragraphs around each important formula or step, and\n"
-                "• Clarify the meaning of symbols and assumptions when they are implicit.\n"
-                "• Include \\usepackage{amsmath} and \\usepackage{amssymb} in the preamble."
+            base_name, source = None, image_path
+        # Denoise in memory; the enhanced image is handed straight to the
+        # vision encoder without a round trip through disk
+        enhanced = run_denoise(in_path=source, processed_dir=None, base_name=base_name)["enhanced_image"]
+        logger.info(f"[{request_id}] Enhanced image {idx + 1}/{len(image_paths)}")
+        return enhanced
+
+    # Images are independent and OpenCV releases the GIL, so denoise them
+    # in parallel threads; map() keeps the results in upload order
+    max_workers = max(1, min(DENOISE_WORKERS, len(image_paths)))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        enhanced_images = list(executor.map(denoise_one, range(len(image_paths)), image_paths))
+
+    logger.info(f"[{request_id}] Enhanced {len(enhanced_images)} images. Preparing for GPT-4o vision API...")
+
+    # Generate meaningful filename with date/time
+    now = datetime.now()
+    date_str = now.strftime('%Y-%m-%d_%H-%M-%S')
+    if len(image_paths) > 1:
+        note_name = f"notes_{date_str}_multi{len(image_paths)}"
+    else:
+        note_name = f"notes_{date_str}"
+
+    # Step 2: Prepare images and call GPT-4o vision API
+    client = get_client(API_KEY, BASE_URL, TIMEOUT_SECONDS, MAX_RETRIES)
+
+    # Warm the LaTeX toolchain while the model generates the note
+    threading.Thread(target=warm_latex_toolchain, daemon=True).start()
+
+    logger.info("[%s] Sending %d image(s) to GPT-4o vision API...", request_id, len(enhanced_images))
+
+    def vision_messages(images):
+        return [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": build_vision_content(images)},
+        ]
+
+    if SPLIT_VISION_REQUESTS and len(enhanced_images) > 1 and on_delta is None:
+        # One request per image, sent concurrently; the resulting documents
+        # are spliced back into a single note
+        def transcribe_one(enhanced):
+            response = create_chat_completion(
+                client,
+                model=MODEL_NAME,
+                messages=vision_messages([enhanced]),
+                stream=False,
+                **CACHE_PARAMS,
             )
-        
-        user_content.append({"type": "text", "text": instruction_text})
-        
-        # Add each enhanced image
-        for idx, enh_path in enumerate(enhanced_images):
-            print(f"[INFO] Encoding image {idx + 1}/{len(enhanced_images)} for vision API...")
-            base64_image = encode_image_to_base64(enh_path)
-            mime_type = get_image_mime_type(enh_path)
-            
-            user_content.append({
-                "type": "image_url",
-                "image_url": {
-                    "url": f"data:{mime_type};base64,{base64_image}"
-                }
-            })
-            
-            if len(enhanced_images) > 1 and idx < len(enhanced_images) - 1:
-                # Add separator text between images
-                user_content.append({
-                    "type": "text",
-                    "text": f"\n--- End of Image {idx + 1} / {len(enhanced_images)} ---\n"
-                })
-
-        print(f"[INFO] Sending {len(enhanced_images)} image(s) to GPT-4o vision API...")
-        
-        response = client.chat.completions.create(
+            return strip_code_fences(response.choices[0].message.content)
+
+        with ThreadPoolExecutor(max_workers=len(enhanced_images)) as executor:
+            latex_source = splice_latex_documents(list(executor.map(transcribe_one, enhanced_images)))
+    elif on_delta is None:
+        response = create_chat_completion(
+            client,
             model=MODEL_NAME,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_content},
-            ],
+            messages=vision_messages(enhanced_images),
             stream=False,
+            **CACHE_PARAMS,
         )
-
         latex_source = response.choices[0].message.content
-        print("[INFO] LLM returned LaTeX.")
-
-        # Clean up markdown code fences if present
-        if latex_source.strip().startswith("```"):
-            latex_source = latex_source.strip().strip("`")
-            if latex_source.startswith("latex"):
-                latex_source = latex_source[5:].strip()
-            if latex_source.startswith("\n"):
-                latex_source = latex_source[1:]
-        
-        # Ensure document has proper structure (only fix if clearly broken)
-        if "\\documentclass" not in latex_source:
-            # Missing document class - wrap the content
-            latex_source = "\\documentclass{article}\n\\usepackage{amsmath}\n\\usepackage{amssymb}\n\\begin{document}\n" + latex_source + "\n\\end{document}"
+    else:
+        stream = create_chat_completion(
+            client,
+            model=MODEL_NAME,
+            messages=vision_messages(enhanced_images),
+            stream=True,
+            **CACHE_PARAMS,
+        )
+        parts = []
+        for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                parts.append(delta)
+                on_delta(delta)
+        latex_source = "".join(parts)
+    logger.info("[%s] LLM returned LaTeX.", request_id)
+
+    # Clean up markdown code fences if present
+    latex_source = strip_code_fences(latex_source)
+
+    # Ensure document has proper structure (only fix if clearly broken)
+    latex_source = ensure_preamble(latex_source)
+
+    # Step 4: Save LaTeX file
+    # Write to a temp file and rename it into place, so /history and the
+    # compiler never see a partially written note
+    tex_path = os.path.join(DOCS_DIR, f"{note_name}.tex")
+    tmp_path = f"{tex_path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(latex_source.encode("utf-8"))
+    os.replace(tmp_path, tex_path)
+    logger.info("[%s] Wrote LaTeX to %s", request_id, tex_path)
+
+    # Step 5: Compile to PDF (optional, may fail if LaTeX not installed)
+    pdf_path = None
+    compilation_error = None
+    compiler = "pdflatex"
+
+    try:
+        if not needs_second_pass(latex_source):
+            # No cross-references: one pdflatex pass gives the final PDF, so
+            # skip latexmk's bookkeeping and extra runs
+            pdf_path = run_pdflatex(note_name, 1)
         else:
-            # Ensure amssymb package is included (needed for symbols like \lhd, \rhd, etc.)
-            if "\\usepackage{amssymb}" not in latex_source and "\\usepackage{amsmath}" in latex_source:
-                latex_source = latex_source.replace("\\usepackage{amsmath}", "\\usepackage{amsmath}\n\\usepackage{amssymb}")
-            elif "\\usepackage{amssymb}" not in latex_source:
-                # Add both packages if neither exists
-                if "\\begin{document}" in latex_source:
-                    latex_source = latex_source.replace("\\begin{document}", "\\usepackage{amsmath}\n\\usepackage{amssymb}\n\\begin{document}")
-                else:
-                    # Add before \documentclass if structure is unusual
-                    if "\\documentclass" in latex_source:
-                        docclass_pos = latex_source.find("\\documentclass")
-                        next_line = latex_source.find("\n", docclass_pos)
-                        if next_line != -1:
-                            latex_source = latex_source[:next_line+1] + "\\usepackage{amsmath}\n\\usepackage{amssymb}\n" + latex_source[next_line+1:]
-            
-            if "\\begin{document}" not in latex_source and "\\end{document}" in latex_source:
-                # Has end but no begin - insert begin before end
-                latex_source = latex_source.replace("\\end{document}", "\\begin{document}\n\\end{document}")
-            elif "\\end{document}" not in latex_source and "\\begin{document}" in latex_source:
-                # Has begin but no end - add end
-                latex_source = latex_source + "\n\\end{document}"
-
-        # Step 4: Save LaTeX file
-        tex_path = os.path.join(DOCS_DIR, f"{note_name}.tex")
-        with open(tex_path, "w") as f:
-            f.write(latex_source)
-        print(f"[INFO] Wrote LaTeX to {tex_path}")
-
-        # Step 5: Compile to PDF (optional, may fail if LaTeX not installed)
-        pdf_path = None
-        compilation_error = None
-        
-        # Try latexmk first
-        try:
-            result = subprocess.run(
-                ["latexmk", "-pdf", "-interaction=nonstopmode", f"{note_name}.tex", f"-outdir={DOCS_DIR}"],
-                check=True,
-                cwd=DOCS_DIR,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                timeout=60,
-            )
-            # latexmk with -outdir creates a subdirectory, check both locations with retry
-            import time
-            pdf_path = None
-            for attempt in range(3):
-                # Check main directory first
-                main_path = os.path.join(DOCS_DIR, f"{note_name}.pdf")
-                if os.path.exists(main_path):
-                    pdf_path = main_path
-                    break
-                # Check subdirectory (latexmk sometimes creates notes_out/notes_out/)
-                subdir_path = os.path.join(DOCS_DIR, DOCS_DIR, f"{note_name}.pdf")
-                if os.path.exists(subdir_path):
-                    pdf_path = subdir_path
-                    break
-                # Wait a bit before retrying (file system might need time)
-                if attempt < 2:
-                    time.sleep(0.5)
-            
-            if pdf_path and os.path.exists(pdf_path):
-                print(f"[INFO] PDF generated → {pdf_path}")
-            else:
-                pdf_path = None
-                print("[WARN] PDF file not found after latexmk compilation")
-                # Try to read log file for errors
-                log_path = os.path.join(DOCS_DIR, DOCS_DIR, f"{note_name}.log")
-                if os.path.exists(log_path):
-                    with open(log_path, 'r', errors='ignore') as f:
-                        log_content = f.read()
-                        if 'Error' in log_content or 'Fatal' in log_content:
-                            # Extract error lines
-                            error_lines = [line for line in log_content.split('\n') if 'Error' in line or 'Fatal' in line]
-                            compilation_error = '\n'.join(error_lines[-5:])  # Last 5 error lines
-                            print(f"[ERROR] LaTeX compilation errors found:\n{compilation_error}")
-        except FileNotFoundError:
-            print("[WARN] latexmk not found, trying pdflatex...")
-            # Fallback to pdflatex
             try:
-                subprocess.run(
-                    ["pdflatex", "-interaction=nonstopmode", f"{note_name}.tex"],
-                    check=True,
-                    cwd=DOCS_DIR,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                    timeout=60,
-                )
-                # Run twice for references
-                subprocess.run(
-                    ["pdflatex", "-interaction=nonstopmode", f"{note_name}.tex"],
-                    check=True,
+                compiler = "latexmk"
+                returncode = subprocess.run(
+                    [
+                        "latexmk", "-pdf", "-interaction=nonstopmode",
+                        f"-auxdir={LATEX_AUX_NAME}", "-outdir=.", f"{note_name}.tex",
+                    ],
                     cwd=DOCS_DIR,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL,
                     timeout=60,
-                )
-                # Check for PDF with retry (file system might need time)
-                import time
-                pdf_path = None
-                for attempt in range(3):
-                    main_path = os.path.join(DOCS_DIR, f"{note_name}.pdf")
-                    if os.path.exists(main_path):
-                        pdf_path = main_path
-                        break
-                    subdir_path = os.path.join(DOCS_DIR, DOCS_DIR, f"{note_name}.pdf")
-                    if os.path.exists(subdir_path):
-                        pdf_path = subdir_path
-                        break
-                    if attempt < 2:
-                        time.sleep(0.5)
-                
-                if pdf_path and os.path.exists(pdf_path):
-                    print(f"[INFO] PDF generated with pdflatex → {pdf_path}")
-                else:
+                ).returncode
+                # -outdir is relative to cwd, so the PDF lands next to the .tex
+                # file and is complete once latexmk has exited. Aux files, the
+                # log and latexmk's dependency database stay in LATEX_AUX_DIR,
+                # so recompiling a note skips passes whose inputs are unchanged.
+                pdf_path = os.path.join(DOCS_DIR, f"{note_name}.pdf")
+                if not os.path.exists(pdf_path):
+                    if returncode:
+                        raise subprocess.CalledProcessError(returncode, "latexmk")
                     pdf_path = None
-                    print("[WARN] PDF file not found after pdflatex compilation")
-            except (FileNotFoundError, subprocess.TimeoutExpired, subprocess.CalledProcessError) as e:
-                print(f"[WARN] pdflatex also failed: {str(e)}")
-                if isinstance(e, subprocess.CalledProcessError):
-                    compilation_error = e.stderr.decode("utf-8", errors="ignore")[:1000]
-        except subprocess.TimeoutExpired:
-            print("[WARN] PDF compilation timed out")
-            compilation_error = "Compilation timed out after 60 seconds"
-        except subprocess.CalledProcessError as e:
-            print("[WARN] LaTeX compilation failed")
-            stderr_output = e.stderr.decode("utf-8", errors="ignore")
-            stdout_output = e.stdout.decode("utf-8", errors="ignore")
-            compilation_error = stderr_output[:1000] if stderr_output else stdout_output[:1000]
-            print(f"[ERROR] Compilation error:\n{compilation_error}")
-            
-            # Try to read log file for more details
-            log_path = os.path.join(DOCS_DIR, DOCS_DIR, f"{note_name}.log")
-            if os.path.exists(log_path):
-                with open(log_path, 'r', errors='ignore') as f:
-                    log_content = f.read()
-                    if 'Error' in log_content or 'Fatal' in log_content:
-                        error_lines = [line for line in log_content.split('\n') if 'Error' in line or 'Fatal' in line]
-                        if error_lines:
-                            compilation_error = '\n'.join(error_lines[-10:])  # Last 10 error lines
-                            print(f"[ERROR] Log file errors:\n{compilation_error}")
-
-        return {
-            "latex": latex_source,
-            "tex_path": tex_path,
-            "pdf_path": pdf_path,
-            "note_name": note_name,
-            "compilation_error": compilation_error
-        }
-    finally:
-        # Clean up temporary processed files
-        try:
-            import shutil
-            if os.path.exists(processed_dir):
-                shutil.rmtree(processed_dir)
-        except:
-            pass
+            except FileNotFoundError:
+                logger.warning("[%s] latexmk not found, trying pdflatex...", request_id)
+                compiler = "pdflatex"
+                pdf_path = run_pdflatex(note_name, 2)
+
+        if pdf_path:
+            logger.info("[%s] PDF generated with %s → %s", request_id, compiler, pdf_path)
+            # A PDF can still come with errors (e.g. an undefined macro)
+            compilation_error = latex_log_errors(note_name, 5)
+            if compilation_error:
+                logger.warning("[%s] LaTeX reported errors:\n%s", request_id, compilation_error)
+        else:
+            logger.warning("[%s] PDF file not found after %s compilation", request_id, compiler)
+            # Try to read log file for errors
+            compilation_error = latex_log_errors(note_name, 5)
+            if compilation_error:
+                logger.error("[%s] LaTeX compilation errors found:\n%s", request_id, compilation_error)
+    except FileNotFoundError as e:
+        logger.warning("[%s] %s not found: %s", request_id, compiler, e)
+    except subprocess.TimeoutExpired:
+        logger.warning("[%s] PDF compilation timed out", request_id)
+        compilation_error = "Compilation timed out after 60 seconds"
+    except subprocess.CalledProcessError as e:
+        logger.warning("[%s] LaTeX compilation failed", request_id)
+        # Compiler output is discarded; the .log file has the details
+        compilation_error = latex_log_errors(note_name, 10) or f"{compiler} exited with status {e.returncode}"
+        logger.error("[%s] Compilation error:\n%s", request_id, compilation_error)
+
+    invalidate_history_cache()
+    return {
+        "latex": latex_source,
+        "tex_path": tex_path,
+        "pdf_path": pdf_path,
+        "note_name": note_name,
+        "compilation_error": compilation_error
+    }
 
 def process_image_to_latex(image_path):
     """
@@ -460,6 +718,71 @@ def process_image_to_latex(image_path):
     """
     return process_images_to_latex([image_path])
 
+def upload_response_data(result, image_count):
+    """Build the /upload response payload from a pipeline result"""
+    response_data = {
+        'latex': result['latex'],
+        'note_name': result['note_name'],
+        'has_pdf': bool(result.get('pdf_path') and os.path.exists(result['pdf_path'])),
+        'image_count': image_count,
+    }
+    if result.get('compilation_error'):
+        response_data['compilation_error'] = result['compilation_error']
+    return response_data
+
+def sse_event(event, data):
+    """Format a Server-Sent Events message with a JSON payload"""
+    return f"event: {event}\ndata: {app.json.dumps(data)}\n\n"
+
+def stream_task(task, error_code, error_message):
+    """
+    Run task(on_delta) in a worker thread and yield SSE messages: a 'delta'
+    event per chunk of text passed to on_delta, then a single 'done' event
+    with the task's return value or an 'error' event.
+    """
+    request_id = getattr(request, 'request_id', 'N/A')
+    events = queue.SimpleQueue()
+
+    @copy_current_request_context
+    def worker():
+        try:
+            events.put(('done', task(lambda text: events.put(('delta', {'text': text})))))
+        except Exception as e:
+            logger.error(f"[{request_id}] {error_message}: {str(e)}", exc_info=True)
+            error = {'code': error_code, 'message': error_message, 'request_id': request_id}
+            if DEBUG:
+                error['details'] = str(e)
+            events.put(('error', error))
+        finally:
+            events.put(None)
+
+    threading.Thread(target=worker, daemon=True).start()
+
+    while True:
+        item = events.get()
+        if item is None:
+            break
+        yield sse_event(*item)
+
+def stream_images_to_latex(images, image_count):
+    """Stream the generated LaTeX for an upload as SSE (see stream_task)."""
+    request_id = getattr(request, 'request_id', 'N/A')
+
+    def task(on_delta):
+        result = process_images_to_latex(images, on_delta=on_delta)
+        logger.info(f"[{request_id}] Successfully streamed {image_count} images")
+        return upload_response_data(result, image_count)
+
+    return stream_task(task, 'PROCESSING_FAILED', 'Image processing failed')
+
+def sse_response(events):
+    """Wrap an SSE generator in an unbuffered event-stream response"""
+    return Response(
+        stream_with_context(events),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
+
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -478,9 +801,8 @@ def upload_file():
     if not files or all(f.filename == '' for f in files):
         return error_response('EMPTY_FILE', 'No file selected', 400)
 
-    # Validate and save files
-    valid_files = []
-    temp_paths = []
+    # Validate files and read them into memory
+    images = []
 
     for idx, file in enumerate(files):
         if file.filename == '':
@@ -488,109 +810,126 @@ def upload_file():
 
         # Validate file type
         if not allowed_file(file.filename):
-            # Clean up already saved files
-            for path in temp_paths:
-                try:
-                    if os.path.exists(path):
-                        os.remove(path)
-                except Exception as e:
-                    logger.warning(f"[{request_id}] Failed to cleanup temp file: {e}")
-
             return error_response(
                 'INVALID_FILE_TYPE',
                 f'Invalid file type for {file.filename}. Allowed: {", ".join(ALLOWED_EXTENSIONS)}',
                 400
             )
 
-        # Check file size (additional to Flask's MAX_CONTENT_LENGTH)
-        file.seek(0, os.SEEK_END)
-        file_size = file.tell()
-        file.seek(0)
-
-        if file_size > MAX_FILE_SIZE_MB * 1024 * 1024:
+        # Check file size (additional to Flask's MAX_CONTENT_LENGTH). Use the
+        # part's declared length when the client sent one; otherwise read at
+        # most one byte past the limit, so sizing and reading are one pass.
+        max_bytes = MAX_FILE_SIZE_MB * 1024 * 1024
+        if file.content_length and file.content_length > max_bytes:
             return error_response(
                 'FILE_TOO_LARGE',
                 f'File {file.filename} exceeds {MAX_FILE_SIZE_MB}MB limit',
                 413
             )
 
-        # Save file
+        # Keep the upload in memory; run_denoise decodes the bytes directly.
+        # The index prefix keeps outputs distinct when filenames repeat.
         filename = secure_filename(file.filename)
-        temp_path = os.path.join(app.config['UPLOAD_FOLDER'], f"upload_{uuid.uuid4()}_{filename}")
+        base_name = f"{len(images):02d}_{os.path.splitext(filename)[0]}"
 
         try:
-            file.save(temp_path)
-            valid_files.append(file)
-            temp_paths.append(temp_path)
-            logger.info(f"[{request_id}] Saved file {idx+1}/{len(files)}: {filename} ({file_size} bytes)")
+            data = file.stream.read(max_bytes + 1)
         except Exception as e:
-            logger.error(f"[{request_id}] Failed to save file {filename}: {e}")
-            return error_response('FILE_SAVE_FAILED', f'Failed to save {filename}', 500, str(e))
+            logger.error(f"[{request_id}] Failed to read file {filename}: {e}")
+            return error_response('FILE_SAVE_FAILED', f'Failed to read {filename}', 500, str(e))
 
-    if not valid_files:
+        if len(data) > max_bytes:
+            return error_response(
+                'FILE_TOO_LARGE',
+                f'File {file.filename} exceeds {MAX_FILE_SIZE_MB}MB limit',
+                413
+            )
+
+        images.append((base_name, data))
+        logger.info(f"[{request_id}] Read file {idx+1}/{len(files)}: {filename} ({len(data)} bytes)")
+
+    if not images:
         return error_response('NO_VALID_FILES', 'No valid files provided', 400)
 
+    # Stream LaTeX to the client as it is generated (Server-Sent Events)
+    if request.args.get('stream', '').lower() in ('1', 'true'):
+        logger.info(f"[{request_id}] Streaming {len(images)} images...")
+        return sse_response(stream_images_to_latex(images, len(images)))
+
     # Process images
     try:
-        logger.info(f"[{request_id}] Processing {len(temp_paths)} images...")
-        result = process_images_to_latex(temp_paths)
-
-        # Build response
-        response_data = {
-            'latex': result['latex'],
-            'note_name': result['note_name'],
-            'has_pdf': bool(result.get('pdf_path') and os.path.exists(result['pdf_path'])),
-            'image_count': len(valid_files),
-        }
-
-        if result.get('compilation_error'):
-            response_data['compilation_error'] = result['compilation_error']
+        logger.info(f"[{request_id}] Processing {len(images)} images...")
+        result = process_images_to_latex(images)
+        response_data = upload_response_data(result, len(images))
 
-        logger.info(f"[{request_id}] Successfully processed {len(valid_files)} images")
+        logger.info(f"[{request_id}] Successfully processed {len(images)} images")
         return success_response(response_data, 'Images processed successfully')
 
     except Exception as e:
         logger.error(f"[{request_id}] Processing failed: {str(e)}", exc_info=True)
         return error_response('PROCESSING_FAILED', 'Image processing failed', 500, str(e))
 
-    finally:
-        # Clean up uploaded files
-        for temp_path in temp_paths:
-            try:
-                if os.path.exists(temp_path):
-                    os.remove(temp_path)
-                    logger.debug(f"[{request_id}] Cleaned up temp file: {temp_path}")
-            except Exception as e:
-                logger.warning(f"[{request_id}] Failed to cleanup {temp_path}: {e}")
+# Notes compiled before latexmk's -outdir was fixed have their PDF and aux
+# files in DOCS_DIR/DOCS_DIR; new notes are always written to DOCS_DIR
+LEGACY_OUTPUT_DIR = os.path.join(DOCS_DIR, DOCS_DIR)
+
+def resolve_pdf(note_name):
+    """Return the path of a note's PDF, or None if it was never compiled"""
+    file_path = os.path.join(DOCS_DIR, f"{note_name}.pdf")
+    if os.path.exists(file_path):
+        return file_path
+    legacy_path = os.path.join(LEGACY_OUTPUT_DIR, f"{note_name}.pdf")
+    if os.path.exists(legacy_path):
+        return legacy_path
+    return None
 
 @app.route('/preview/<note_name>')
 def preview_pdf(note_name):
     """Preview the generated PDF file"""
-    # Check both possible locations (latexmk may create subdirectory)
-    file_path = os.path.join(DOCS_DIR, f"{note_name}.pdf")
-    if not os.path.exists(file_path):
-        subdir_path = os.path.join(DOCS_DIR, DOCS_DIR, f"{note_name}.pdf")
-        if os.path.exists(subdir_path):
-            file_path = subdir_path
-    
-    if os.path.exists(file_path):
+    file_path = resolve_pdf(note_name)
+    if file_path:
         return send_file(file_path, mimetype='application/pdf')
     return jsonify({'error': 'PDF not found'}), 404
 
+# Serialized /history payload, keyed on the modification times of the notes
+# directories; notes only change on upload/delete, which also invalidate it
+history_cache = {'entry': None}  # (cache key, JSON payload)
+
+def history_cache_key():
+    key = []
+    for path in (DOCS_DIR, LEGACY_OUTPUT_DIR):
+        try:
+            key.append(os.stat(path).st_mtime_ns)
+        except OSError:
+            key.append(None)
+    return tuple(key)
+
+def invalidate_history_cache():
+    history_cache['entry'] = None
+
 @app.route('/history')
 def get_history():
     """Get list of all generated notes organized by date"""
+    cache_key = history_cache_key()
+    cached = history_cache['entry']
+    if cached is not None and cached[0] == cache_key:
+        return Response(cached[1], mimetype='application/json')
+
     notes = []
     
-    # Scan notes_out directory for .tex files
+    # Scan notes_out directory for .tex files in a single pass; DirEntry
+    # caches stat() results and the PDF names are collected once up front
     if os.path.exists(DOCS_DIR):
-        for filename in os.listdir(DOCS_DIR):
+        with os.scandir(DOCS_DIR) as it:
+            entries = list(it)
+        pdf_names = {entry.name for entry in entries if entry.name.endswith('.pdf')}
+        for entry in entries:
+            filename = entry.name
             if filename.endswith('.tex'):
                 note_name = filename[:-4]  # Remove .tex extension
-                tex_path = os.path.join(DOCS_DIR, filename)
                 
                 # Get file modification time
-                mtime = os.path.getmtime(tex_path)
+                mtime = entry.stat().st_mtime
                 date_created = datetime.fromtimestamp(mtime)
                 
                 # Extract date from filename if it follows the pattern notes_YYYY-MM-DD_HH-MM-SS
@@ -613,41 +952,37 @@ def get_history():
                         if '_' in date_part:
                             date_str, time_str = date_part.split('_', 1)
                             parsed_date = datetime.strptime(f"{date_str}_{time_str}", '%Y-%m-%d_%H-%M-%S')
+                            display_name = f"Notes from {parsed_date.strftime('%B %d, %Y at %I:%M %p')}"
                             if is_multi and image_count:
-                                display_name = f"Notes from {parsed_date.strftime('%B %d, %Y at %I:%M %p')} ({image_count} images)"
-                            else:
-                                display_name = f"Notes from {parsed_date.strftime('%B %d, %Y at %I:%M %p')}"
+                                display_name += f" ({image_count} images)"
                     except:
                         # If parsing fails, use the original name
                         pass
                 
                 # Check if PDF exists
-                pdf_path = os.path.join(DOCS_DIR, f"{note_name}.pdf")
-                pdf_exists = os.path.exists(pdf_path)
+                pdf_exists = f"{note_name}.pdf" in pdf_names
                 if not pdf_exists:
-                    # Check subdirectory
-                    subdir_pdf = os.path.join(DOCS_DIR, DOCS_DIR, f"{note_name}.pdf")
-                    pdf_exists = os.path.exists(subdir_pdf)
+                    pdf_exists = os.path.exists(os.path.join(LEGACY_OUTPUT_DIR, f"{note_name}.pdf"))
                 
-                notes.append({
+                notes.append((date_created, {
                     'note_name': note_name,
                     'display_name': display_name,
                     'date_created': date_created.isoformat(),
                     'date_display': date_created.strftime('%B %d, %Y at %I:%M %p'),
                     'date_sort': date_created.strftime('%Y-%m-%d'),
                     'has_pdf': pdf_exists
-                })
+                }))
     
     # Sort by date (newest first)
-    notes.sort(key=lambda x: x['date_created'], reverse=True)
+    notes.sort(key=lambda x: x[0], reverse=True)
     
-    # Group by date
+    # Group by date, reusing the datetime parsed above for each note
     grouped_notes = {}
-    for note in notes:
+    for date_created, note in notes:
         date_key = note['date_sort']
         if date_key not in grouped_notes:
             grouped_notes[date_key] = {
-                'date_display': datetime.fromisoformat(note['date_created']).strftime('%B %d, %Y'),
+                'date_display': date_created.strftime('%B %d, %Y'),
                 'notes': []
             }
         grouped_notes[date_key]['notes'].append(note)
@@ -655,7 +990,12 @@ def get_history():
     # Convert to list sorted by date (newest first)
     history = [{'date': k, **v} for k, v in sorted(grouped_notes.items(), reverse=True)]
     
-    return jsonify({'history': history})
+    payload = app.json.dumps({'history': history})
+    history_cache['entry'] = (cache_key, payload)
+    return Response(payload, mimetype='application/json')
+
+# Files a note may leave behind: the source, the PDF and LaTeX aux files
+NOTE_FILE_EXTENSIONS = {'.tex', '.pdf', '.aux', '.log', '.fls', '.fdb_latexmk'}
 
 @app.route('/delete/<note_name>', methods=['DELETE'])
 def delete_note(note_name):
@@ -663,51 +1003,27 @@ def delete_note(note_name):
     deleted_files = []
     errors = []
     
-    # Delete .tex file
-    tex_path = os.path.join(DOCS_DIR, f"{note_name}.tex")
-    if os.path.exists(tex_path):
-        try:
-            os.remove(tex_path)
-            deleted_files.append(f"{note_name}.tex")
-        except Exception as e:
-            errors.append(f"Failed to delete .tex: {str(e)}")
-    
-    # Delete .pdf file (check both locations)
-    pdf_path = os.path.join(DOCS_DIR, f"{note_name}.pdf")
-    if os.path.exists(pdf_path):
-        try:
-            os.remove(pdf_path)
-            deleted_files.append(f"{note_name}.pdf")
-        except Exception as e:
-            errors.append(f"Failed to delete .pdf: {str(e)}")
-    else:
-        # Check subdirectory
-        subdir_pdf = os.path.join(DOCS_DIR, DOCS_DIR, f"{note_name}.pdf")
-        if os.path.exists(subdir_pdf):
+    # Delete the note's files in one directory scan per location (the
+    # legacy output directory only holds notes compiled before the -outdir fix)
+    output_dirs = [DOCS_DIR, LATEX_AUX_DIR]
+    if os.path.normpath(LEGACY_OUTPUT_DIR) != os.path.normpath(DOCS_DIR):
+        output_dirs.append(LEGACY_OUTPUT_DIR)
+    for directory in output_dirs:
+        for path in glob.iglob(os.path.join(glob.escape(directory), f"{glob.escape(note_name)}.*")):
+            filename = os.path.basename(path)
+            ext = filename[len(note_name):]
+            if ext not in NOTE_FILE_EXTENSIONS:
+                continue
             try:
-                os.remove(subdir_pdf)
-                deleted_files.append(f"{note_name}.pdf")
+                os.remove(path)
+                deleted_files.append(filename)
             except Exception as e:
-                errors.append(f"Failed to delete .pdf: {str(e)}")
-    
-    # Delete auxiliary files (.aux, .log, .fls, .fdb_latexmk)
-    aux_extensions = ['.aux', '.log', '.fls', '.fdb_latexmk']
-    for ext in aux_extensions:
-        aux_path = os.path.join(DOCS_DIR, f"{note_name}{ext}")
-        if os.path.exists(aux_path):
-            try:
-                os.remove(aux_path)
-                deleted_files.append(f"{note_name}{ext}")
-            except:
-                pass  # Ignore errors for auxiliary files
-        # Also check subdirectory
-        subdir_aux = os.path.join(DOCS_DIR, DOCS_DIR, f"{note_name}{ext}")
-        if os.path.exists(subdir_aux):
-            try:
-                os.remove(subdir_aux)
-            except:
-                pass
+                if ext in ('.tex', '.pdf'):
+                    errors.append(f"Failed to delete {ext}: {str(e)}")
+                # Ignore errors for auxiliary files
     
+    invalidate_history_cache()
+
     if errors:
         return jsonify({'error': '; '.join(errors), 'deleted': deleted_files}), 500
     
@@ -722,13 +1038,8 @@ def download_file(note_name):
     file_type = request.args.get('type', 'tex')  # 'tex' or 'pdf'
     
     if file_type == 'pdf':
-        # Check both possible locations (latexmk may create subdirectory)
-        file_path = os.path.join(DOCS_DIR, f"{note_name}.pdf")
-        if not os.path.exists(file_path):
-            subdir_path = os.path.join(DOCS_DIR, DOCS_DIR, f"{note_name}.pdf")
-            if os.path.exists(subdir_path):
-                file_path = subdir_path
-        if os.path.exists(file_path):
+        file_path = resolve_pdf(note_name)
+        if file_path:
             return send_file(file_path, as_attachment=True, download_name=f"{note_name}.pdf")
     else:
         file_path = os.path.join(DOCS_DIR, f"{note_name}.tex")
@@ -755,6 +1066,16 @@ def chat():
 
         logger.info(f"[{request_id}] Chat request: {message[:50]}... (llm={use_llm})")
 
+        # Stream LLM-written text as it is generated (Server-Sent Events);
+        # the final 'done' event carries the formatted reply
+        if request.args.get('stream', '').lower() in ('1', 'true'):
+            def task(on_delta):
+                reply = format_reply(math_engine(message, use_llm=use_llm, on_delta=on_delta))
+                logger.info(f"[{request_id}] Chat reply streamed ({len(reply)} chars)")
+                return {'reply': reply, 'used_llm': use_llm}
+
+            return sse_response(stream_task(task, 'CHAT_FAILED', 'Failed to process chat message'))
+
         reply = math_engine(message, use_llm=use_llm)
         formatted_reply = format_reply(reply)
 
@@ -783,6 +1104,8 @@ def submit_feedback():
         "comments": "optional free-text comments"
     }
     """
+    request_id = getattr(request, 'request_id', 'N/A')
+
     try:
         data = request.json or {}
 
@@ -811,16 +1134,13 @@ def submit_feedback():
 
         # Store as JSONL (one line per feedback)
         filename = os.path.join(FEEDBACK_DIR, f"{note_name}_feedback.jsonl")
-        with open(filename, "a", encoding="utf-8") as f:
-            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        feedback_writer.write(filename, record)
 
-        print(f"[INFO] Saved feedback for {note_name}")
+        logger.info(f"[{request_id}] Queued feedback for {note_name}")
         return jsonify({"success": True, "saved_to": filename})
 
     except Exception as e:
-        print(f"[ERROR] Feedback save failed: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.error(f"[{request_id}] Feedback save failed: {str(e)}", exc_info=True)
         return jsonify({"error": str(e)}), 500
 
 @app.route('/health', methods=['GET'])
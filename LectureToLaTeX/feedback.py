@@ -1,15 +1,33 @@
 # feedback.py
+import atexit
+import logging
 import os
-import json
+import queue
 from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
 from flask import Flask, request, jsonify
+from jsonl_writer import JSONLWriter
 
 app = Flask(__name__)
 
+# Request threads only enqueue log records; a background listener writes them
+log_queue = queue.SimpleQueue()
+log_listener = QueueListener(log_queue, logging.StreamHandler())
+log_listener.start()
+atexit.register(log_listener.stop)
+
+logger = logging.getLogger(__name__)
+logger.addHandler(QueueHandler(log_queue))
+logger.setLevel(logging.INFO)
+logger.propagate = False
+
 # Directory to store RLHF-style feedback
 FEEDBACK_DIR = "notes_feedback"
 os.makedirs(FEEDBACK_DIR, exist_ok=True)
 
+# Feedback lines are appended in batches by a background thread
+feedback_writer = JSONLWriter()
+
 
 @app.route('/')
 def index():
@@ -61,14 +79,13 @@ def submit_feedback():
 
         # Store as JSONL (one line per feedback)
         filename = os.path.join(FEEDBACK_DIR, f"{note_name}_feedback.jsonl")
-        with open(filename, "a", encoding="utf-8") as f:
-            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        feedback_writer.write(filename, record)
 
-        print(f"[INFO] Saved feedback for {note_name}")
+        logger.info("Queued feedback for %s", note_name)
         return jsonify({"success": True, "saved_to": filename})
 
     except Exception as e:
-        print(f"[ERROR] Feedback save failed: {str(e)}")
+        logger.exception("Feedback save failed: %s", e)
         return jsonify({"error": str(e)}), 500
 
 
@@ -0,0 +1,22 @@
+# Gunicorn configuration for serving app.py in production
+# Usage: gunicorn -c gunicorn.conf.py app:app
+
+import multiprocessing
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+bind = f"{os.getenv('HOST', '0.0.0.0')}:{os.getenv('PORT', '8000')}"
+
+# Requests spend most of their time waiting on the OpenAI API, so each worker
+# process runs a pool of threads instead of handling one request at a time.
+worker_class = "gthread"
+workers = int(os.getenv("GUNICORN_WORKERS", str(multiprocessing.cpu_count())))
+threads = int(os.getenv("GUNICORN_THREADS", "8"))
+
+# Leave room for the LLM call plus LaTeX compilation
+timeout = int(os.getenv("TIMEOUT_SECONDS", "120")) + 60
+graceful_timeout = 30
+keepalive = 5
@@ -0,0 +1,84 @@
+# jsonl_writer.py
+# Background writer that batches JSON-lines appends
+
+import atexit
+import json
+import logging
+import queue
+import threading
+import time
+from collections import defaultdict
+
+# Optional: orjson serializes several times faster than the stdlib encoder
+try:
+    import orjson
+except Exception:
+    orjson = None
+
+FLUSH_INTERVAL_SECONDS = 0.1
+MAX_BATCH_RECORDS = 1000
+
+logger = logging.getLogger(__name__)
+
+
+def dumps_line(record):
+    """Serialize one record as UTF-8 JSON bytes (non-ASCII kept as-is)."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(record)
+        except TypeError:
+            pass  # e.g. integers beyond 64 bits; the stdlib handles those
+    return json.dumps(record, ensure_ascii=False).encode("utf-8")
+
+
+class JSONLWriter:
+    """
+    Append JSON records to .jsonl files from a single background thread.
+
+    write() only serializes the record and enqueues it, so request handlers
+    never wait on the disk. The writer thread collects records for up to
+    flush_interval seconds and appends each file's lines with one open/write.
+    """
+
+    def __init__(self, flush_interval=FLUSH_INTERVAL_SECONDS, max_batch=MAX_BATCH_RECORDS):
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="jsonl-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.flush)
+
+    def write(self, path, record):
+        self._queue.put((path, dumps_line(record)))
+
+    def flush(self):
+        """Block until every record written so far is on disk."""
+        self._queue.join()
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            lines_by_path = defaultdict(list)
+            for path, line in batch:
+                lines_by_path[path].append(line)
+            for path, lines in lines_by_path.items():
+                try:
+                    with open(path, "ab") as f:
+                        f.write(b"\n".join(lines) + b"\n")
+                except Exception:
+                    logger.exception("Failed to append %d record(s) to %s", len(lines), path)
+            for _ in batch:
+                self._queue.task_done()
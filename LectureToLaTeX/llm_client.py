@@ -0,0 +1,192 @@
+# llm_client.py
+# Shared entry point for OpenAI chat completion calls
+
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import httpx
+from openai import OpenAI
+
+# Optional: persist cached responses on disk, shared by all worker processes
+try:
+    import diskcache
+except Exception:
+    diskcache = None
+
+CACHE_MAX_ENTRIES = 1000
+CACHE_TTL_SECONDS = 1800
+# Directory for the on-disk response cache (requires diskcache); unset keeps
+# the cache in memory only
+CACHE_DIR = os.getenv("LLM_CACHE_DIR")
+
+# Connection pool shared by all requests in a worker process
+MAX_CONNECTIONS = 200
+MAX_KEEPALIVE_CONNECTIONS = 50
+
+# Retries after the first attempt on rate limits (429), 5xx responses and
+# connection errors. The SDK backs off exponentially with jitter and honours
+# Retry-After headers.
+MAX_RETRIES = 3
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(api_key, base_url=None, timeout=None, max_retries=MAX_RETRIES):
+    """
+    Return the process-wide OpenAI client for this configuration, creating
+    it on first use. Reusing one client keeps TLS connections alive across
+    requests instead of reconnecting for every call.
+    """
+    key = (api_key, base_url, timeout, max_retries)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            http_client = httpx.Client(
+                limits=httpx.Limits(
+                    max_connections=MAX_CONNECTIONS,
+                    max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+                ),
+                timeout=timeout,
+            )
+            kwargs = {"api_key": api_key, "http_client": http_client, "max_retries": max_retries}
+            if base_url:
+                kwargs["base_url"] = base_url
+            if timeout is not None:
+                kwargs["timeout"] = timeout
+            client = OpenAI(**kwargs)
+            _clients[key] = client
+        return client
+
+
+class LLMCache:
+    """
+    Thread-safe LRU cache of chat completion responses with a TTL.
+
+    With a cache_dir (and diskcache installed) entries are also written to
+    disk, so they survive restarts and are shared between Gunicorn workers;
+    the in-memory LRU stays in front of it for the hottest keys.
+    """
+
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES, ttl_seconds=CACHE_TTL_SECONDS, cache_dir=None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk = diskcache.Cache(cache_dir) if cache_dir and diskcache is not None else None
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                response, stored_at = entry
+                if time.monotonic() - stored_at <= self.ttl_seconds:
+                    self._entries.move_to_end(key)
+                    return response
+                del self._entries[key]
+        if self._disk is None:
+            return None
+        response = self._disk.get(key)
+        if response is not None:
+            self._remember(key, response)
+        return response
+
+    def set(self, key, response):
+        self._remember(key, response)
+        if self._disk is not None:
+            self._disk.set(key, response, expire=self.ttl_seconds)
+
+    def _remember(self, key, response):
+        with self._lock:
+            self._entries[key] = (response, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+        if self._disk is not None:
+            self._disk.clear()
+
+
+_cache = LLMCache(cache_dir=CACHE_DIR)
+
+
+class _PendingCall:
+    """A chat completion request that is currently waiting on the API."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.response = None
+        self.error = None
+
+
+_pending = {}
+_pending_lock = threading.Lock()
+
+
+def _request_key(client, params):
+    """Hash the endpoint and request parameters into a stable lookup key."""
+    payload = json.dumps(
+        {"base_url": str(client.base_url), "params": params},
+        sort_keys=True,
+        ensure_ascii=False,
+        default=str,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def create_chat_completion(client, cacheable=None, **params):
+    """
+    Call client.chat.completions.create(**params).
+
+    Identical requests that overlap in time share a single API call: the
+    first caller sends the request and the others wait for its response.
+    Streaming requests are always sent on their own.
+
+    Deterministic requests (temperature 0) are also served from the
+    response cache, so repeated questions skip the API entirely. Pass
+    cacheable=True to cache a sampled request whose answer may be reused
+    (e.g. an explanation), or cacheable=False to never cache.
+    """
+    if params.get("stream"):
+        return client.chat.completions.create(**params)
+
+    key = _request_key(client, params)
+    if cacheable is None:
+        cacheable = params.get("temperature") == 0
+    if cacheable:
+        cached = _cache.get(key)
+        if cached is not None:
+            return cached
+
+    with _pending_lock:
+        call = _pending.get(key)
+        is_leader = call is None
+        if is_leader:
+            call = _PendingCall()
+            _pending[key] = call
+
+    if not is_leader:
+        call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return call.response
+
+    try:
+        call.response = client.chat.completions.create(**params)
+        if cacheable:
+            _cache.set(key, call.response)
+        return call.response
+    except Exception as e:
+        call.error = e
+        raise
+    finally:
+        with _pending_lock:
+            _pending.pop(key, None)
+        call.done.set()
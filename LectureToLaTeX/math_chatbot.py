@@ -5,6 +5,7 @@ import os
 import re
 import ast
 import difflib
+from functools import lru_cache
 from typing import Optional, Dict, Any
 
 # Optional deps
@@ -14,19 +15,27 @@ except Exception:
     sp = None
 
 # OpenAI API client
-from openai import OpenAI
+from llm_client import LLMCache, create_chat_completion, get_client
 
 # Configuration
 MODEL_NAME = "gpt-4o"  # OpenAI GPT-4o model
 API_KEY = os.environ.get("OPENAI_API_KEY") or os.environ.get("DEEPSEEK_API_KEY") or "sk-your-key-here"
 BASE_URL = None  # None uses default OpenAI endpoint
-
-# Initialize client
+# Same settings as app.py, so both share one pooled client
+TIMEOUT_SECONDS = int(os.getenv("TIMEOUT_SECONDS", "120"))
+MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "3"))
+# Derivative/integral/limit results longer than this (as LaTeX) get simplified
+SIMPLIFY_MIN_LATEX_CHARS = int(os.getenv("MATH_SIMPLIFY_MIN_CHARS", "120"))
+
+# Requests sharing this key are routed to the same OpenAI prompt cache, so the
+# static system prompts below are only prefilled once. Custom endpoints may not
+# accept the parameter, so it is only sent to OpenAI itself.
+PROMPT_CACHE_KEY = "math-chatbot"
+CACHE_PARAMS = {} if BASE_URL else {"extra_body": {"prompt_cache_key": PROMPT_CACHE_KEY}}
+
+# Initialize client (process-wide, keeps connections alive across requests)
 try:
-    if BASE_URL:
-        client = OpenAI(api_key=API_KEY, base_url=BASE_URL)
-    else:
-        client = OpenAI(api_key=API_KEY)  # Use default OpenAI endpoint
+    client = get_client(API_KEY, BASE_URL, TIMEOUT_SECONDS, MAX_RETRIES)
     LLM_AVAILABLE = bool(API_KEY and API_KEY != "sk-your-key-here")
 except Exception:
     LLM_AVAILABLE = False
@@ -56,11 +65,15 @@ MATH_HELP = (
 )
 
 # ---------------- Pretty rendering helpers ----------------
+_RE_DISPLAY_MATH = re.compile(r"\\\[(.*?)\\\]", re.S)
+_RE_TO_OO = re.compile(r"(?<=\\to)\s*oo")
+_RE_LIM_OO = re.compile(r"\\lim_\{([^}]*)\\to\s*oo\}")
+
 def _latex_clean(s: str) -> str:
     """Normalize common outputs to valid LaTeX."""
-    s = re.sub(r"\\\[(.*?)\\\]", r"$$\1$$", s, flags=re.S)
-    s = re.sub(r"(?<=\\to)\s*oo", r" \\infty", s)
-    s = re.sub(r"\\lim_\{([^}]*)\\to\s*oo\}", r"\\lim_{\1\\to \\infty}", s)
+    s = _RE_DISPLAY_MATH.sub(r"$$\1$$", s)
+    s = _RE_TO_OO.sub(r" \\infty", s)
+    s = _RE_LIM_OO.sub(r"\\lim_{\1\\to \\infty}", s)
     s = s.replace("$$$$", "$$")
     return s.strip()
 
@@ -77,6 +90,7 @@ _KEYWORDS = ["derivative", "differentiate", "d/dx",
              "solve", "solution", "roots",
              "simplify", "factor", "expand", "explain"]
 
+@lru_cache(maxsize=1024)
 def fuzzy_fix_keyword(word: str, cutoff=0.75):
     m = difflib.get_close_matches(word, _KEYWORDS, n=1, cutoff=cutoff)
     return m[0] if m else word
@@ -89,14 +103,14 @@ def fuzzy_fix_ops(text: str) -> str:
         toks[1] = fuzzy_fix_keyword(toks[1].lower())
     return " ".join(toks)
 
+_RE_LN = re.compile(r"\b(ln)\b")
+# One pass for every function: "sin x"/"sinx" -> sin(x), "sin 2x" -> sin(2x)
+_RE_FUNC_ARG = re.compile(r"\b(sin|cos|tan|cot|sec|csc|log|sqrt)\s*(\d+[a-zA-Z]|[a-zA-Z]\b)")
+
 def insert_parens_after_func(expr: str) -> str:
     """sinx -> sin(x), sin 2x -> sin(2*x), ln x -> log(x), sqrtx -> sqrt(x)"""
-    expr = re.sub(r"\b(ln)\b", "log", expr)
-    for func in ["sin","cos","tan","cot","sec","csc","log","sqrt"]:
-        expr = re.sub(rf"\b{func}\s*([a-zA-Z]\b)", rf"{func}(\1)", expr)
-        expr = re.sub(rf"\b{func}([a-zA-Z])\b",     rf"{func}(\1)", expr)
-        expr = re.sub(rf"\b{func}\s*(\d+[a-zA-Z])", rf"{func}(\1)", expr)
-    return expr
+    expr = _RE_LN.sub("log", expr)
+    return _RE_FUNC_ARG.sub(r"\1(\2)", expr)
 
 def balance_parens(expr: str) -> str:
     opens = expr.count("("); closes = expr.count(")")
@@ -117,18 +131,53 @@ if sp is not None:
         convert_xor,
         function_exponentiation,
     )
+    _X = sp.Symbol("x")
+
+    # Most SymPy expressions are immutable, so parsed and simplified results
+    # can be shared between requests (students often resend the same
+    # expression). Mutable results (e.g. Matrix) are never shared.
+    @lru_cache(maxsize=2048)
+    def _parse(s: str):
+        return parse_expr(s, transformations=_TRANSFORMS, evaluate=True, local_dict={"e": sp.E})
 
     def try_parse(expr_txt: str):
         """Heuristics + SymPy parse_expr, with graceful fallback."""
         s = (expr_txt or "").strip().replace("'", "'")
         s = insert_parens_after_func(s)
         s = balance_parens(s)
-        locals_map = {"e": sp.E}
-        return parse_expr(s, transformations=_TRANSFORMS, evaluate=True, local_dict=locals_map)
+        expr = _parse(s)
+        return expr if isinstance(expr, sp.Basic) or not hasattr(expr, "copy") else expr.copy()
+
+    @lru_cache(maxsize=2048)
+    def _simplify_cached(expr, ratio):
+        return sp.simplify(expr, ratio=ratio)
+
+    def _simplify(expr, ratio=1.7):
+        # Only sp.Basic objects are hashable; a mutable Matrix can't be a key
+        if isinstance(expr, sp.Basic):
+            return _simplify_cached(expr, ratio)
+        return sp.simplify(expr, ratio=ratio)
+
+    def _tidy(expr):
+        """
+        Light cleanup for CAS results: diff/integrate/limit output is usually
+        already readable, and sp.simplify often costs more than the operation
+        itself, so only long results get a (bounded) simplify.
+        """
+        if len(sp.latex(expr)) <= SIMPLIFY_MIN_LATEX_CHARS:
+            return expr
+        return _simplify(expr, ratio=1.5)
 else:
     def try_parse(expr_txt: str):
         return None
 
+_RE_OP_EXPLAIN = re.compile(r"^(explain|what\s+is|define|why\s+is|intuition\s+for)\s+(.+)$")
+_RE_OP_DERIVATIVE = re.compile(r"(?:what(?:'|)s\s+the\s+)?(?:derivative|differentiate|d/dx)\s+(?:of\s+)?(.+)")
+_RE_OP_INTEGRAL = re.compile(r"(?:integral|integrate)\s+(?:of\s+)?(.+?)\s*(?:from\s+([^\s]+)\s+to\s+([^\s]+))?$")
+_RE_OP_LIMIT = re.compile(r"limit\s*(.+?)\s*as\s*([a-zA-Z])\s*->\s*([^\s]+)")
+_RE_OP_SOLVE = re.compile(r"(?:solve|roots|solution)\s+(.+)")
+_RE_OP_ALGEBRA = re.compile(r"(simplify|factor|expand)\s+(.+)")
+
 def detect_math_op_local(raw: str):
     """
     Typo-tolerant intent detection for basic ops + 'explain' concept queries.
@@ -138,29 +187,62 @@ def detect_math_op_local(raw: str):
     t = fuzzy_fix_ops(t.lower().replace("'","'"))
 
     # explain / what is / define / why queries
-    m = re.search(r"^(explain|what\s+is|define|why\s+is|intuition\s+for)\s+(.+)$", t)
+    m = _RE_OP_EXPLAIN.search(t)
     if m:
         topic = m.group(2).strip(" ?.")
         return "explain", {"topic": topic}
 
-    m = re.search(r"(?:what(?:'|)s\s+the\s+)?(?:derivative|differentiate|d/dx)\s+(?:of\s+)?(.+)", t)
+    m = _RE_OP_DERIVATIVE.search(t)
     if m: return "derivative", {"expr": m.group(1).strip()}
 
-    m = re.search(r"(?:integral|integrate)\s+(?:of\s+)?(.+?)\s*(?:from\s+([^\s]+)\s+to\s+([^\s]+))?$", t)
+    m = _RE_OP_INTEGRAL.search(t)
     if m: return "integral", {"expr": m.group(1).strip(), "a": m.group(2), "b": m.group(3)}
 
-    m = re.search(r"limit\s*(.+?)\s*as\s*([a-zA-Z])\s*->\s*([^\s]+)", t)
+    m = _RE_OP_LIMIT.search(t)
     if m: return "limit", {"expr": m.group(1).strip(), "var": m.group(2), "to": m.group(3)}
 
-    m = re.search(r"(?:solve|roots|solution)\s+(.+)", t)
+    m = _RE_OP_SOLVE.search(t)
     if m: return "solve", {"expr": m.group(1).strip()}
 
-    m = re.search(r"(simplify|factor|expand)\s+(.+)", t)
+    m = _RE_OP_ALGEBRA.search(t)
     if m: return m.group(1).lower(), {"expr": m.group(2).strip()}
 
     return None, {}
 
 # ---------- LLM helpers ----------
+def _complete(messages, temperature, on_delta=None, cacheable=None) -> str:
+    """
+    Run a chat completion and return the reply text. With on_delta the reply
+    is streamed and each text chunk is passed to on_delta as it arrives.
+    """
+    if on_delta is None:
+        resp = create_chat_completion(
+            client,
+            model=MODEL_NAME,
+            messages=messages,
+            temperature=temperature,
+            cacheable=cacheable,
+            **CACHE_PARAMS,
+        )
+        return resp.choices[0].message.content.strip()
+    stream = create_chat_completion(
+        client,
+        model=MODEL_NAME,
+        messages=messages,
+        temperature=temperature,
+        stream=True,
+        **CACHE_PARAMS,
+    )
+    parts = []
+    for chunk in stream:
+        if not chunk.choices:
+            continue
+        text = chunk.choices[0].delta.content
+        if text:
+            parts.append(text)
+            on_delta(text)
+    return "".join(parts).strip()
+
 LLM_PARSE_SYS = (
     "You convert natural-language math questions into a JSON instruction for a CAS (SymPy). "
     "Return compact JSON with keys: op in {derivative,integral,limit,solve,simplify,factor,expand,none}, "
@@ -173,11 +255,13 @@ def llm_parse_math(raw: str) -> Dict[str, Any]:
     if not LLM_AVAILABLE:
         return {"op":"none"}
     try:
-        resp = client.chat.completions.create(
+        resp = create_chat_completion(
+            client,
             model=MODEL_NAME,
             messages=[{"role":"system","content":LLM_PARSE_SYS},
-                      {"role":"user","content":raw}],
+                      {"role":"user","content":" ".join(raw.split())}],
             temperature=0.0,
+            **CACHE_PARAMS,
         )
         text = resp.choices[0].message.content.strip()
         import json
@@ -193,20 +277,31 @@ LLM_EXPLAIN_SYS = (
     "Use LaTeX inline when helpful; keep it concise."
 )
 
-def llm_explain(user_q: str, result_text: str) -> Optional[str]:
+def llm_explain(user_q: str, result_text: str, on_delta=None) -> Optional[str]:
     if not LLM_AVAILABLE:
         return None
     try:
-        resp = client.chat.completions.create(
-            model=MODEL_NAME,
-            messages=[{"role":"system","content":LLM_EXPLAIN_SYS},
-                      {"role":"user","content":f"Question: {user_q}\nCAS result: {result_text}"}],
+        return _complete(
+            [{"role":"system","content":LLM_EXPLAIN_SYS},
+             {"role":"user","content":f"Question: {user_q}\nCAS result: {result_text}"}],
             temperature=0.2,
+            on_delta=on_delta,
+            cacheable=True,  # same question + result -> reuse the explanation
         )
-        return resp.choices[0].message.content.strip()
     except Exception:
         return None
 
+LLM_TUTOR_SYS = "You are a helpful math tutor. Use LaTeX for math, be concise."
+
+def llm_tutor(user_q: str, on_delta=None) -> str:
+    """Free-form tutor answer, used when the CAS route fails. Raises on API errors."""
+    return _complete(
+        [{"role":"system","content":LLM_TUTOR_SYS},
+         {"role":"user","content":user_q}],
+        temperature=0.2,
+        on_delta=on_delta,
+    )
+
 # Concept explainer + offline fallback
 LLM_EXPLAIN_CONCEPT_SYS = (
     "You are a kind math TA. Explain the requested math concept clearly in 6-10 short bullets, "
@@ -257,23 +352,33 @@ _OFFLINE_KB = {
 """,
 }
 
-def llm_explain_concept(topic: str) -> str:
+# Concept explanations, keyed by the normalized topic
+_concept_cache = LLMCache()
+
+def llm_explain_concept(topic: str, on_delta=None) -> str:
     """Explain a concept with the LLM; fallback to a tiny offline note."""
-    t = (topic or "").strip()
+    t = " ".join((topic or "").split())
+    # Cache key only: trivial variants ("Eigenvalues ", "eigenvalues") share
+    # one cached answer, while the model still sees the topic as written
+    key = t.lower()
     if LLM_AVAILABLE:
+        cached = _concept_cache.get(key)
+        if cached is not None:
+            if on_delta is not None:
+                on_delta(cached)
+            return cached
         try:
-            resp = client.chat.completions.create(
-                model=MODEL_NAME,
-                messages=[
-                    {"role":"system","content":LLM_EXPLAIN_CONCEPT_SYS},
-                    {"role":"user","content":f"Explain this concept: {t}"}
-                ],
+            answer = _complete(
+                [{"role":"system","content":LLM_EXPLAIN_CONCEPT_SYS},
+                 {"role":"user","content":f"Explain this concept: {t}"}],
                 temperature=0.2,
+                on_delta=on_delta,
+                cacheable=True,
             )
-            return resp.choices[0].message.content.strip()
+            _concept_cache.set(key, answer)
+            return answer
         except Exception:
             pass  # fall through to offline
-    key = t.lower().strip()
     for k in _OFFLINE_KB:
         if k in key:
             return _OFFLINE_KB[k]
@@ -291,11 +396,9 @@ def do_sympy_compute(op: str, info: Dict[str, Any]) -> str:
     """Run the CAS operation with SymPy based on parsed plan (pretty LaTeX)."""
     if sp is None:
         return "SymPy isn't installed. Add `sympy` to requirements.txt."
-    x, y, z, n, t = sp.symbols("x y z n t")
-
     if op == "derivative":
         expr = try_parse(info["expr"])
-        deriv = sp.simplify(sp.diff(expr, x))
+        deriv = _tidy(sp.diff(expr, _X))
         return f"$$\\frac{{d}}{{dx}}\\,{to_latex(expr)} = {to_latex(deriv)}$$"
 
     if op == "integral":
@@ -303,9 +406,9 @@ def do_sympy_compute(op: str, info: Dict[str, Any]) -> str:
         a, b = info.get("a"), info.get("b")
         if a and b:
             aval = try_parse(a); bval = try_parse(b)
-            val = sp.simplify(sp.integrate(expr, (x, aval, bval)))
+            val = _tidy(sp.integrate(expr, (_X, aval, bval)))
             return f"$$\\int_{{{to_latex(aval)}}}^{{{to_latex(bval)}}} {to_latex(expr)}\\,dx = {to_latex(val)}$$"
-        ant = sp.simplify(sp.integrate(expr, x))
+        ant = _tidy(sp.integrate(expr, _X))
         return f"$$\\int {to_latex(expr)}\\,dx = {to_latex(ant)} + C$$"
 
     if op == "limit":
@@ -315,7 +418,7 @@ def do_sympy_compute(op: str, info: Dict[str, Any]) -> str:
         to_val = sp.oo if to_txt in ["oo","+inf","+infty","infinity"] else \
                  -sp.oo if to_txt in ["-oo","-inf"] else try_parse(to_txt)
         pretty_to = r"\infty" if to_val == sp.oo else (r"-\infty" if to_val == -sp.oo else to_latex(to_val))
-        res = sp.simplify(sp.limit(expr, var, to_val))
+        res = _tidy(sp.limit(expr, var, to_val))
         return f"$$\\lim_{{{to_latex(var)}\\to {pretty_to}}} {to_latex(expr)} = {to_latex(res)}$$"
 
     if op == "solve":
@@ -342,17 +445,22 @@ def do_sympy_compute(op: str, info: Dict[str, Any]) -> str:
         expr = try_parse(info["expr"])
         if op == "factor":  return f"$$\\mathrm{{factor}}\\big({to_latex(expr)}\\big) = {to_latex(sp.factor(expr))}$$"
         if op == "expand":  return f"$$\\mathrm{{expand}}\\big({to_latex(expr)}\\big) = {to_latex(sp.expand(expr))}$$"
-        return f"$$\\mathrm{{simplify}}\\big({to_latex(expr)}\\big) = {to_latex(sp.simplify(expr))}$$"
+        return f"$$\\mathrm{{simplify}}\\big({to_latex(expr)}\\big) = {to_latex(_simplify(expr))}$$"
 
     return "I couldn't parse that.\n\n" + MATH_HELP
 
-def math_engine(prompt: str, use_llm: bool = True) -> str:
+_RE_EXPLAIN = re.compile(r"(?i)\b(explain|what\s+is|define|why\s+is|intuition\s+for)\b")
+
+def math_engine(prompt: str, use_llm: bool = True, on_delta=None) -> str:
     """
     1) Concept queries -> explainer (LLM/offline).
     2) Try to parse intent locally (typo tolerant).
     3) Execute with SymPy (robust parser).
     4) Bare expression fallback (e.g., '9+10').
     5) LLM-assisted parsing/explanation if still unresolved.
+
+    With on_delta, LLM-written text is streamed to it while it is generated;
+    the returned string is still the complete reply.
     """
     if sp is None:
         return "SymPy isn't installed. Add `sympy` to requirements.txt."
@@ -360,10 +468,10 @@ def math_engine(prompt: str, use_llm: bool = True) -> str:
     raw = (prompt or "").strip()
 
     # --- Early: detect concept explanations before any CAS work ---
-    if re.match(r"(?i)\b(explain|what\s+is|define|why\s+is|intuition\s+for)\b", raw):
-        topic = re.sub(r"(?i)\b(explain|what\s+is|define|why\s+is|intuition\s+for)\b", "", raw).strip(" ?.")
+    if _RE_EXPLAIN.match(raw):
+        topic = _RE_EXPLAIN.sub("", raw).strip(" ?.")
         topic = topic or raw
-        return llm_explain_concept(topic)
+        return llm_explain_concept(topic, on_delta=on_delta)
 
     # 1) Plan via local detector
     op, info = detect_math_op_local(raw)
@@ -372,7 +480,7 @@ def math_engine(prompt: str, use_llm: bool = True) -> str:
     # 1.5) If detector says "explain", route to explainer
     if plan["op"] == "explain":
         topic = plan.get("topic", raw)
-        return llm_explain_concept(topic)
+        return llm_explain_concept(topic, on_delta=on_delta)
 
     # 2) Compute with SymPy if possible
     if plan["op"] != "none":
@@ -384,7 +492,7 @@ def math_engine(prompt: str, use_llm: bool = True) -> str:
     # 3) Bare expression fallback
     try:
         expr = try_parse(raw)
-        val = sp.simplify(expr)
+        val = _simplify(expr)
         if getattr(val, "is_Number", False):
             return f"$${to_latex(val)}$$"
         if val != expr:
@@ -400,21 +508,15 @@ def math_engine(prompt: str, use_llm: bool = True) -> str:
         if plan.get("op") != "none":
             try:
                 result = do_sympy_compute(plan["op"], plan)
-                expl = llm_explain(raw, result)
-                return result + ("\n\n" + expl if expl else "")
             except Exception:
                 try:
-                    resp = client.chat.completions.create(
-                        model=MODEL_NAME,
-                        messages=[
-                            {"role":"system","content":"You are a helpful math tutor. Use LaTeX for math, be concise."},
-                            {"role":"user","content":raw}
-                        ],
-                        temperature=0.2,
-                    )
-                    return resp.choices[0].message.content.strip()
+                    return llm_tutor(raw, on_delta=on_delta)
                 except Exception as e:
                     return f"LLM error: {e}"
+            if on_delta is not None:
+                on_delta(result + "\n\n")
+            expl = llm_explain(raw, result, on_delta=on_delta)
+            return result + ("\n\n" + expl if expl else "")
 
     # Last resort
     return "I couldn't parse that.\n\n" + MATH_HELP
@@ -22,7 +22,8 @@ def enhance_chalkboard(img):
     gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
     blur = cv2.medianBlur(gray, 3)
     _, th = cv2.threshold(blur, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
-    if np.mean(th) < 127:
+    # th is 0/255, so this is np.mean(th) < 127 without a float64 pass
+    if cv2.countNonZero(th) * 255 < 127 * th.size:
         th = cv2.bitwise_not(th)
     kernel = np.ones((2,2), np.uint8)
     opened = cv2.morphologyEx(th, cv2.MORPH_OPEN, kernel)
@@ -32,16 +33,20 @@ def enhance_chalkboard(img):
 
 IN_DIR = "pre_out"
 OUT_DIR = "out_denoise"
+IMAGE_EXTENSIONS = frozenset({"jpg", "jpeg", "png"})
+SKIP_PREFIXES = frozenset({"00_", "01_", "02_", "03_"})
 
 os.makedirs(OUT_DIR, exist_ok=True)
-for root, _, files in os.walk(IN_DIR):
-    for filename in files:
-        if not filename.lower().endswith((".jpg", ".jpeg", ".png")):
+with os.scandir(IN_DIR) as entries:
+    for entry in entries:
+        filename = entry.name
+        if not entry.is_file():
             continue
-        if filename.startswith(("00_", "01_", "02_", "03_")):
+        if filename.rsplit(".", 1)[-1].lower() not in IMAGE_EXTENSIONS:
             continue
-        in_path = os.path.join(root, filename)
-        img = cv2.imread(in_path, cv2.IMREAD_COLOR)
+        if filename[:3] in SKIP_PREFIXES:
+            continue
+        img = cv2.imread(entry.path, cv2.IMREAD_COLOR)
         if img is None:
             continue
         enh, edg = enhance_chalkboard(img)
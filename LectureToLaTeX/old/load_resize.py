@@ -1,50 +1,86 @@
 import cv2
+import multiprocessing
 import os
 
+import numpy as np
+
 IN_PATH = "/Users/kai/Downloads/SampleNotes.jpg" #CHANGE TO IMAGE FILE NAME !!!
-OUT_DIR = "pre_out"
+PRE_OUT_DIR = "pre_out"
+IN_DIR = "pre_out"
+OUT_DIR = "out_scaled" #I feel like we need to add another directory with the rescaled images and then have a separate one for the denoised ones
 MAX_SIDE = 2000
+IMAGE_EXTENSIONS = frozenset({"jpg", "jpeg", "png"})
+# Outputs of the single-image steps, not inputs
+SKIP_PREFIXES = frozenset({"00_", "01_", "02_", "03_"})
+
 
-os.makedirs(OUT_DIR, exist_ok=True)
+def is_batch_image(entry):
+    name = entry.name
+    return (
+        entry.is_file()
+        and name.rsplit(".", 1)[-1].lower() in IMAGE_EXTENSIONS
+        and name[:3] not in SKIP_PREFIXES
+    )
 
-img = cv2.imread(IN_PATH, cv2.IMREAD_COLOR)
-if img is None:
-    raise FileNotFoundError(f"Couldn't read {IN_PATH}")
-cv2.imwrite(os.path.join(OUT_DIR, "00_original.jpg"), img)
 
-h, w = img.shape[:2]
-long_side = max(h, w)
-if long_side > MAX_SIDE:
-    scale = MAX_SIDE / long_side
+def resize_long_side(img, max_side=MAX_SIDE):
+    h, w = img.shape[:2]
+    long_side = max(h, w)
+    if long_side <= max_side:
+        return img
+    scale = max_side / long_side
     new_w, new_h = int(w * scale), int(h * scale)
-    img = cv2.resize(img, (new_w, new_h), interpolation=cv2.INTER_AREA)
-cv2.imwrite(os.path.join(OUT_DIR, "01_resized.jpg"), img)
+    # UMat runs the resize through OpenCL (e.g. an iGPU) when available and
+    # falls back to the CPU otherwise
+    try:
+        return cv2.resize(cv2.UMat(img), (new_w, new_h), interpolation=cv2.INTER_AREA).get()
+    except cv2.error:
+        return cv2.resize(img, (new_w, new_h), interpolation=cv2.INTER_AREA)
 
-print("Saved:")
-print("pre_out/00_original.jpg")
-print("pre_out/01_resized.jpg")
 
-IN_DIR = "pre_out"
-OUT_DIR = "out_scaled" #I feel like we need to add another directory with the rescaled images and then have a separate one for the denoised ones
-MAX_SIDE = 2000
+def read_image(path):
+    # One sequential read (with a read-ahead hint on Linux) + in-memory decode
+    try:
+        with open(path, "rb") as f:
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            data = f.read()
+    except OSError:
+        return None
+    return cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+
+
+def _process(in_path):
+    filename = os.path.basename(in_path)
+    img = read_image(in_path)
+    if img is None:
+        return None
+    img = resize_long_side(img)
+    cv2.imwrite(os.path.join(OUT_DIR, f"rescaled_{filename}"), img)
+    return filename
+
+
+if __name__ == "__main__":
+    os.makedirs(PRE_OUT_DIR, exist_ok=True)
+
+    img = cv2.imread(IN_PATH, cv2.IMREAD_COLOR)
+    if img is None:
+        raise FileNotFoundError(f"Couldn't read {IN_PATH}")
+    cv2.imwrite(os.path.join(PRE_OUT_DIR, "00_original.jpg"), img)
+    img = resize_long_side(img)
+    cv2.imwrite(os.path.join(PRE_OUT_DIR, "01_resized.jpg"), img)
+
+    print("Saved:")
+    print("pre_out/00_original.jpg")
+    print("pre_out/01_resized.jpg")
+
+    os.makedirs(OUT_DIR, exist_ok=True)
+    with os.scandir(IN_DIR) as entries:
+        file_list = [entry.path for entry in entries if is_batch_image(entry)]
 
-os.makedirs(OUT_DIR, exist_ok=True)
-for root, _, files in os.walk(IN_DIR):
-    for filename in files:
-        if not filename.lower().endswith((".jpg", ".jpeg", ".png")):
-            continue
-        if filename.startswith(("00_", "01_", "02_", "03_")):
-            continue
-        in_path = os.path.join(root, filename)
-        img = cv2.imread(in_path, cv2.IMREAD_COLOR)
-        if img is None:
-            continue
-        h, w = img.shape[:2]
-        long_side = max(h, w)
-        if long_side > MAX_SIDE:
-            scale = MAX_SIDE / long_side
-            new_w, new_h = int(w * scale), int(h * scale)
-            img = cv2.resize(img, (new_w, new_h), interpolation=cv2.INTER_AREA)
-        cv2.imwrite(os.path.join(OUT_DIR, f"rescaled_{filename}"), img)
-        print(f"Processed {filename}")
-print("All images saved in:", OUT_DIR)
+    # Files are independent, so decode/resize/encode them on every core
+    with multiprocessing.Pool(os.cpu_count()) as pool:
+        for filename in pool.imap_unordered(_process, file_list):
+            if filename is not None:
+                print(f"Processed {filename}")
+    print("All images saved in:", OUT_DIR)
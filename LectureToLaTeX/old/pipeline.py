@@ -1,36 +1,51 @@
+import hashlib
 import os
+import re
+import shutil
 import subprocess
-from openai import OpenAI
+import threading
+import cv2
+import numpy as np
 from denoise_pipeline import run_denoise
+from llm_client import get_client
 import pytesseract
 from PIL import Image
 
+# Tesseract's OpenMP thread count is read from the environment when it
+# starts; one thread per core unless the caller already chose
+os.environ.setdefault("OMP_THREAD_LIMIT", str(os.cpu_count() or 1))
+
+# Optional: tesserocr calls the Tesseract C API in-process, so the language
+# model loads once instead of in a new tesseract subprocess per image
+try:
+    from tesserocr import PyTessBaseAPI, OEM, PSM
+except Exception:
+    PyTessBaseAPI = None
+
 # =============== CONFIG ===============
 DOCS_DIR = "notes_out"       
+# OCR text and LaTeX of every processed image, keyed by image content
+CACHE_DIR = os.path.join(DOCS_DIR, ".cache")
 MODEL_NAME = "deepseek-chat"
 API_KEY = os.environ.get("DEEPSEEK_API_KEY") or "sk-your-key-here"
 BASE_URL = "https://api.deepseek.com"
+TIMEOUT_SECONDS = int(os.getenv("TIMEOUT_SECONDS", "120"))
+# LSTM engine only, and treat the board as one block of text: skips the
+# full automatic layout analysis
+TESSERACT_CONFIG = "--oem 1 --psm 6"
+# pdflatex's intermediates (aux, log, toc, latexmk's database) live on the
+# RAM-backed tmpfs when there is one; only the PDF is written to DOCS_DIR.
+# The directory is kept between runs so latexmk can still skip passes.
+if os.path.isdir("/dev/shm"):
+    _docs_id = hashlib.blake2b(os.path.abspath(DOCS_DIR).encode(), digest_size=6).hexdigest()
+    LATEX_AUX_DIR = os.path.join("/dev/shm", f"lecture_latex_{_docs_id}")
+else:
+    LATEX_AUX_DIR = os.path.join(DOCS_DIR, ".latexcache")
 # ======================================
 
-os.makedirs(DOCS_DIR, exist_ok=True)
-
-print("[INFO] Running denoise pipeline on image from raw/ ...")
-paths = run_denoise()   # PASS IN IMAGE OF YOUR CHOICE AS PARAMETER in_path="raw/some_other.jpg" 
-enh_path = paths["enhanced"]
-
-image_base = paths['base_name']
-note_name = f"notes_{image_base}"
-print(f"[INFO] Using enhanced image for OCR: {enh_path}")
-
-# ===== 1) OCR the processed image =====
-ocr_text = pytesseract.image_to_string(Image.open(enh_path))
-print(ocr_text)
-print("[INFO] OCR text extracted.")
-
-# ===== 2) Call LLM with text only =====
-client = OpenAI(api_key=API_KEY, base_url=BASE_URL)
-
-system_prompt = (
+# Kept byte-identical across runs and placed first, so DeepSeek's automatic
+# context cache can serve this prefix instead of prefilling it every time
+SYSTEM_PROMPT = (
     "You are a LaTeX math transcription AND explanation assistant. "
     "You will be given rough OCR output from a blackboard in an abstract algebra lecture. "
     "The lecture concerns *groups, subgroups, normal subgroups, quotient groups, cosets, "
@@ -71,8 +86,8 @@ system_prompt = (
     "Output ONLY the LaTeX document. No commentary or markdown."
 )
 
-
-user_prompt = (
+# Only the OCR text at the very end changes between runs
+USER_PROMPT_TEMPLATE = (
     "Here is the raw OCR output from a math blackboard image. "
     "The OCR may have mistakes, missing backslashes, or broken fractions. "
     "Please:\n"
@@ -86,50 +101,241 @@ user_prompt = (
     "\n"
     "without introducing unrelated topics like field extensions or cyclotomic fields.\n\n"
     "Remember to output only LaTeX (no markdown) and to make it fully compilable.\n\n"
-    f"OCR START:\n{ocr_text}\nOCR END."
+    "OCR START:\n{ocr_text}\nOCR END."
 )
 
+_tess_api = None
+
+def tess_api():
+    """The process-wide tesserocr engine, created on first use."""
+    global _tess_api
+    if _tess_api is None:
+        _tess_api = PyTessBaseAPI(lang="eng", psm=PSM.SINGLE_BLOCK, oem=OEM.LSTM_ONLY)
+    return _tess_api
+
+def ocr_image(image, png_path):
+    """
+    OCR an image array. tesserocr takes it in memory; otherwise it is written
+    once to png_path (fast PNG level) and tesseract reads that file itself,
+    instead of pytesseract re-encoding a PIL image on every call.
+    """
+    if PyTessBaseAPI is not None:
+        api = tess_api()
+        api.SetImage(Image.fromarray(image))
+        return api.GetUTF8Text()
+    cv2.imwrite(png_path, image, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+    return pytesseract.image_to_string(png_path, lang="eng", config=TESSERACT_CONFIG)
+
+# Slight stroke thickening after thresholding
+OCR_KERNEL = np.ones((2, 2), np.uint8)
 
-response = client.chat.completions.create(
-    model=MODEL_NAME,
-    messages=[
-        {"role": "system", "content": system_prompt},
-        {"role": "user", "content": user_prompt},
-    ],
-    stream=False,
+def preprocess_for_ocr(image):
+    """Adaptive-threshold a BGR image into dark text on a white background."""
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    # Chalkboards are light-on-dark; the threshold below (and Tesseract)
+    # expect dark text on a light background
+    if cv2.mean(gray)[0] < 127:
+        cv2.bitwise_not(gray, dst=gray)
+    # A local threshold copes with uneven lighting across the board
+    th = cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 31, 10)
+    # Eroding the white background thickens the dark strokes
+    return cv2.erode(th, OCR_KERNEL)
+
+# Lines where fewer than this share of the non-space characters are letters or
+# digits are OCR noise (kept low: math lines are symbol-heavy)
+MIN_ALNUM_RATIO = 0.25
+
+def clean_ocr_text(text):
+    """Drop blank/noise lines, collapse whitespace and repeated lines."""
+    lines = []
+    for line in text.splitlines():
+        line = " ".join(line.split())
+        if not line:
+            continue
+        chars = line.replace(" ", "")
+        if sum(c.isalnum() for c in chars) / len(chars) < MIN_ALNUM_RATIO:
+            continue
+        if lines and lines[-1] == line:
+            continue
+        lines.append(line)
+    return "\n".join(lines)
+
+# With fewer letters/digits than this the OCR found nothing worth sending
+# (blank board, bad photo); the model could only make something up
+MIN_OCR_ALNUM_CHARS = 20
+EMPTY_DOC_TEMPLATE = (
+    "\\documentclass[12pt]{article}\n"
+    "\\begin{document}\n"
+    "No readable text was found on the board.\n"
+    "\\end{document}\n"
 )
 
-latex_source = response.choices[0].message.content
-print("[INFO] LLM returned LaTeX.")
+TEX_WRITE_BUFFER = 1 << 20
+CODE_FENCE_RE = re.compile(r"\A\s*```[A-Za-z]*[ \t]*\n?|\s*```\s*\Z")
 
-if latex_source.strip().startswith("```"):
-    latex_source = latex_source.strip().strip("`")
+def image_digest(image, *settings):
+    """Content hash of an image array (pixels + shape) and the settings used on it."""
+    h = hashlib.blake2b(digest_size=16)
+    h.update(repr(image.shape).encode())
+    h.update(np.ascontiguousarray(image).data)
+    for value in settings:
+        h.update(b"\0" + value.encode("utf-8"))
+    return h.hexdigest()
 
-tex_path = os.path.join(DOCS_DIR, f"{note_name}.tex")
-with open(tex_path, "w") as f:
-    f.write(latex_source)
+def warm_llm_connection(client):
+    """Open the pooled HTTPS connection to the API (DNS + TLS) ahead of use."""
+    try:
+        client.with_options(max_retries=0).models.list()
+    except Exception:
+        pass  # the real request will connect (and report errors) itself
 
-print(f"[INFO] Wrote LaTeX to {tex_path}")
+def copy_atomic(src, dst):
+    shutil.copyfile(src, dst + ".tmp")
+    os.replace(dst + ".tmp", dst)
 
-# ===== 3) Compile to PDF =====
-try:
-    subprocess.run(
-        ["latexmk", "-pdf", f"{note_name}.tex", f"-outdir={DOCS_DIR}"],
-        check=True,
-        cwd=DOCS_DIR,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-    )
-    print(f"[INFO] PDF generated → {os.path.join(DOCS_DIR, f'{note_name}.pdf')}")
-except FileNotFoundError:
-    print("[WARN] latexmk not found, trying pdflatex...")
-    subprocess.run(
-        ["pdflatex", f"{note_name}.tex"],
-        check=True,
-        cwd=DOCS_DIR,
-    )
-    print(f"[INFO] PDF generated → {os.path.join(DOCS_DIR, f'{note_name}.pdf')}")
-except subprocess.CalledProcessError as e:
-    print("[ERROR] LaTeX compilation failed.")
-    print(e.stdout.decode("utf-8", errors="ignore"))
-    print(e.stderr.decode("utf-8", errors="ignore"))
+if __name__ == "__main__":
+    os.makedirs(DOCS_DIR, exist_ok=True)
+    os.makedirs(CACHE_DIR, exist_ok=True)
+
+    print("[INFO] Running denoise pipeline on image from raw/ ...")
+    paths = run_denoise()   # PASS IN IMAGE OF YOUR CHOICE AS PARAMETER in_path="raw/some_other.jpg" 
+    enh_path = paths["enhanced"]
+
+    image_base = paths['base_name']
+    note_name = f"notes_{image_base}"
+    print(f"[INFO] Denoised and enhanced {image_base} (enhanced image: {enh_path})")
+
+    # OCR input: the denoised image, adaptively thresholded for Tesseract
+    ocr_input = preprocess_for_ocr(paths["denoised_image"])
+
+    # Re-running on an unchanged image reuses its OCR text and LaTeX
+    # The keys also cover everything that shapes the output, so changing the
+    # Tesseract flags, the model or the prompts doesn't serve stale results
+    ocr_key = image_digest(ocr_input, TESSERACT_CONFIG)
+    tex_key = image_digest(ocr_input, TESSERACT_CONFIG, MODEL_NAME, SYSTEM_PROMPT, USER_PROMPT_TEMPLATE)
+    ocr_cache_path = os.path.join(CACHE_DIR, f"{ocr_key}.ocr.txt")
+    tex_cache_path = os.path.join(CACHE_DIR, f"{tex_key}.tex")
+
+    # Pooled keep-alive client with retry/backoff on 429/5xx, shared with the app
+    client = get_client(API_KEY, BASE_URL, TIMEOUT_SECONDS)
+    # Connect to the API in the background while Tesseract keeps the CPU busy
+    if not os.path.exists(tex_cache_path):
+        threading.Thread(target=warm_llm_connection, args=(client,), daemon=True).start()
+
+    # ===== 1) OCR the processed image =====
+    if os.path.exists(ocr_cache_path):
+        with open(ocr_cache_path, encoding="utf-8") as f:
+            ocr_text = f.read()
+        print("[INFO] Reusing cached OCR text.")
+    else:
+        ocr_path = os.path.join(os.path.dirname(enh_path), f"{image_base}_ocr.png")
+        ocr_text = ocr_image(ocr_input, ocr_path)
+        with open(ocr_cache_path + ".tmp", "w", encoding="utf-8") as f:
+            f.write(ocr_text)
+        os.replace(ocr_cache_path + ".tmp", ocr_cache_path)
+        print(ocr_text)
+        print("[INFO] OCR text extracted.")
+
+    # ===== 2) Call LLM with text only =====
+    # Whitespace, blank lines and symbol-only noise cost prompt tokens but carry
+    # nothing the model can use
+    ocr_text = clean_ocr_text(ocr_text)
+
+    tex_path = os.path.join(DOCS_DIR, f"{note_name}.tex")
+    if os.path.exists(tex_cache_path):
+        copy_atomic(tex_cache_path, tex_path)
+        print("[INFO] Reusing cached LaTeX for this image.")
+    elif sum(c.isalnum() for c in ocr_text) < MIN_OCR_ALNUM_CHARS:
+        with open(tex_path, "w", encoding="utf-8") as f:
+            f.write(EMPTY_DOC_TEMPLATE)
+        print("[WARN] OCR found almost no text; skipping the LLM call.")
+    else:
+        response = client.chat.completions.create(
+            model=MODEL_NAME,
+            messages=[
+                {"role": "system", "content": SYSTEM_PROMPT},
+                {"role": "user", "content": USER_PROMPT_TEMPLATE.format(ocr_text=ocr_text)},
+            ],
+            stream=True,
+        )
+
+        # Write the LaTeX to disk chunk by chunk as the model generates it, into a
+        # temporary file that replaces the .tex once the stream is complete.
+        # Binary mode with a 1 MiB buffer: the deltas are encoded once and
+        # reach the disk in a few large writes.
+        tmp_path = tex_path + ".tmp"
+        with open(tmp_path, "wb", buffering=TEX_WRITE_BUFFER) as f:
+            for chunk in response:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    f.write(chunk.choices[0].delta.content.encode("utf-8"))
+        print("[INFO] LLM returned LaTeX.")
+
+        # Rare case: the model wrapped the document in a code fence anyway
+        with open(tmp_path, encoding="utf-8") as f:
+            fenced = f.read(64).lstrip().startswith("```")
+        if fenced:
+            with open(tmp_path, encoding="utf-8") as f:
+                latex_source = CODE_FENCE_RE.sub("", f.read()).strip()
+            with open(tmp_path, "wb", buffering=TEX_WRITE_BUFFER) as f:
+                f.write(latex_source.encode("utf-8"))
+        os.replace(tmp_path, tex_path)
+        copy_atomic(tex_path, tex_cache_path)
+
+    print(f"[INFO] Wrote LaTeX to {tex_path}")
+
+    # ===== 3) Compile to PDF =====
+    latex_cache_dir = os.path.join(DOCS_DIR, ".latexcache")
+    os.makedirs(latex_cache_dir, exist_ok=True)
+    latex_aux_dir = os.path.abspath(LATEX_AUX_DIR)
+    os.makedirs(latex_aux_dir, exist_ok=True)
+    pdf_path = os.path.join(DOCS_DIR, f"{note_name}.pdf")
+    # Hash of the .tex the current PDF was built from; an unchanged .tex skips
+    # the compile entirely
+    tex_hash_path = os.path.join(latex_cache_dir, f"{note_name}.tex.sha256")
+    with open(tex_path, "rb") as f:
+        tex_hash = hashlib.sha256(f.read()).hexdigest()
+
+    def pdf_is_current():
+        if not os.path.exists(pdf_path) or not os.path.exists(tex_hash_path):
+            return False
+        with open(tex_hash_path, encoding="utf-8") as f:
+            return f.read() == tex_hash
+
+    def record_tex_hash():
+        with open(tex_hash_path, "w", encoding="utf-8") as f:
+            f.write(tex_hash)
+
+    # latexmk's console output goes straight to a build log on disk and is only
+    # read back if the compile fails
+    build_log_path = os.path.join(latex_cache_dir, f"{note_name}.build.log")
+    if pdf_is_current():
+        print(f"[INFO] PDF is up to date → {pdf_path}")
+    else:
+        try:
+            with open(build_log_path, "wb") as build_log:
+                subprocess.run(
+                    # The PDF lands next to the .tex (cwd), aux files and latexmk's
+                    # dependency database in the reusable aux directory
+                    ["latexmk", "-pdf", "-interaction=nonstopmode", "-halt-on-error",
+                     f"-auxdir={latex_aux_dir}", "-outdir=.", f"{note_name}.tex"],
+                    check=True,
+                    cwd=DOCS_DIR,
+                    stdout=build_log,
+                    stderr=subprocess.STDOUT,
+                )
+            record_tex_hash()
+            print(f"[INFO] PDF generated → {pdf_path}")
+        except FileNotFoundError:
+            print("[WARN] latexmk not found, trying pdflatex...")
+            subprocess.run(
+                ["pdflatex", f"-output-directory={latex_aux_dir}", f"{note_name}.tex"],
+                check=True,
+                cwd=DOCS_DIR,
+            )
+            shutil.move(os.path.join(latex_aux_dir, f"{note_name}.pdf"), pdf_path)
+            record_tex_hash()
+            print(f"[INFO] PDF generated → {pdf_path}")
+        except subprocess.CalledProcessError:
+            print("[ERROR] LaTeX compilation failed.")
+            with open(build_log_path, "rb") as f:
+                print(f.read().decode("utf-8", errors="ignore"))
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Make the app modules (app.py, denoise_pipeline.py, ...) importable
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
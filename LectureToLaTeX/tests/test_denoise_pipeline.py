@@ -0,0 +1,31 @@
+import types
+
+import numpy as np
+
+import denoise_pipeline
+
+
+def test_cuda_denoise_passes_window_sizes_by_keyword(monkeypatch):
+    calls = []
+
+    class FakeGpuMat:
+        def upload(self, img):
+            self.img = img
+
+        def download(self):
+            return self.img
+
+    def fake_denoise(src, h_luminance, photo_render, dst=None, search_window=21, block_size=7, stream=None):
+        calls.append({"h_luminance": h_luminance, "photo_render": photo_render, "dst": dst,
+                      "search_window": search_window, "block_size": block_size})
+        return src
+
+    monkeypatch.setattr(denoise_pipeline, "USE_CUDA", True)
+    monkeypatch.setattr(denoise_pipeline.cv2, "cuda_GpuMat", FakeGpuMat, raising=False)
+    monkeypatch.setattr(denoise_pipeline.cv2, "cuda",
+                        types.SimpleNamespace(fastNlMeansDenoisingColored=fake_denoise), raising=False)
+
+    img = np.zeros((4, 4, 3), np.uint8)
+    assert denoise_pipeline.denoise(img, strength=10) is img
+    assert calls == [{"h_luminance": 10, "photo_render": 10, "dst": None,
+                      "search_window": 21, "block_size": 7}]
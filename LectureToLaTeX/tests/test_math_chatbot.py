@@ -0,0 +1,46 @@
+import math_chatbot
+
+
+def test_bare_matrix_expression_is_answered_locally():
+    reply = math_chatbot.math_engine("Matrix([[1,2],[3,4]])*2", use_llm=False)
+    assert reply == r"$$\left[\begin{matrix}2 & 4\\6 & 8\end{matrix}\right]$$"
+
+
+def test_parsed_matrix_is_not_shared_between_calls():
+    first = math_chatbot.try_parse("Matrix([[1,2],[3,4]])")
+    first[0, 0] = 99
+    assert math_chatbot.try_parse("Matrix([[1,2],[3,4]])")[0, 0] == 1
+
+
+def fake_complete(calls):
+    def complete(messages, temperature, on_delta=None, cacheable=None):
+        answer = "About " + messages[1]["content"]
+        calls.append(messages[1]["content"])
+        if on_delta is not None:
+            on_delta(answer)
+        return answer
+    return complete
+
+
+def test_concept_cache_reuses_answer_for_trivial_variants(monkeypatch):
+    calls = []
+    monkeypatch.setattr(math_chatbot, "LLM_AVAILABLE", True)
+    monkeypatch.setattr(math_chatbot, "_complete", fake_complete(calls))
+    monkeypatch.setattr(math_chatbot, "_concept_cache", math_chatbot.LLMCache())
+
+    first = math_chatbot.llm_explain_concept("Eigenvalues ")
+    deltas = []
+    assert math_chatbot.llm_explain_concept("eigenvalues", on_delta=deltas.append) == first
+    # The model sees the topic as written; cache hits are still streamed
+    assert calls == ["Explain this concept: Eigenvalues"]
+    assert deltas == [first]
+
+
+def test_concept_cache_keeps_similar_topics_apart(monkeypatch):
+    calls = []
+    monkeypatch.setattr(math_chatbot, "LLM_AVAILABLE", True)
+    monkeypatch.setattr(math_chatbot, "_complete", fake_complete(calls))
+    monkeypatch.setattr(math_chatbot, "_concept_cache", math_chatbot.LLMCache())
+
+    assert math_chatbot.llm_explain_concept("eigenvalues") != math_chatbot.llm_explain_concept("eigenvectors")
+    assert len(calls) == 2